@@ -5,6 +5,9 @@ Also includes a commandline interface.
 import math
 import random
 import heapq
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
 
 from ms.util import *
 
@@ -34,43 +37,257 @@ def relative_shared_peak(sample, weights, tolerance=1.2):
     return shared_peak(sample, weights, tolerance)/len(weights)
 
 
+def top_shared_peaks(proteins, sample, pairs, amount, tolerance=1.2) -> '[(protein, score)]':
+    """The same best proteins as scoring all of them with relative_shared_peak, when
+    pairs has the amount of (peak, weight) pairs within tolerance of every protein with
+    any. shared_peak counts a pair at most once, so that bounds the score: proteins are
+    scored best bound first, until none of the others can make it. Ties are broken on
+    index."""
+    if amount < 1:
+        return []
+    bounds = sorted((-count/len(proteins[i].weights), i) for i, count in pairs.items())
+    heap = []
+    for bound, i in bounds:
+        if len(heap) == amount and -bound < heap[0][0]:
+            break
+        item = (relative_shared_peak(sample, proteins[i].weights, tolerance), -i)
+        if len(heap) < amount:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+    
+    best = [(-i, score) for score, i in sorted(heap, reverse=True) if score > 0]
+    scored = {i for i, score in best}
+    i = 0
+    while len(best) < amount and i < len(proteins):
+        if i not in scored:
+            best.append((i, 0.0))
+        i += 1
+    return [(proteins[i], score) for i, score in best]
+
+
 class ProteinDB(Pickled):
     default_file = data_loc('uniprot_sprot_human.fasta')
     
-    def __init__(self, fname=None, missed_cleavages=0, reverse=False):
+    # See build_arrays
+    weight_values = None
+    weight_offsets = None
+    sorted_weights = None
+    sorted_owners = None
+    # See build_mass_index
+    mass_index = None
+    
+    def __init__(self, fname=None, missed_cleavages=0, reverse=False, arrays=False, mass_index=False):
         fname = fname or self.default_file
         self.proteins = list(map((reversed if reverse else identity), read_fasta(fname)))
         
         chunker = trypsine(missed_cleavages)
         for prot in progress_bar(self.proteins, 'Loading proteins' + (' in reverse' if reverse else '')):
-            prot.chunks = list(chunker(prot.seq))
-            prot.weights = sorted(set(peptide_mass(c) for c in prot.chunks))
+            prot.chunks = [prot.seq[start:end] for start, end in chunker.spans(prot.seq)]
+            # Not the prefix masses of digest: chunks with the same composition have to give
+            # exactly the same weight, or they count twice in the scores
+            prot.weights = sorted(set(map(peptide_mass, set(prot.chunks))))
+        
+        if arrays:
+            self.build_arrays()
+        if mass_index:
+            self.build_mass_index()
+    
+    @simple_progress('Building weight arrays')
+    def build_arrays(self):
+        """Stores the weights of all proteins in flat arrays, CSR-style: the weights of protein
+        i are weight_values[weight_offsets[i]:weight_offsets[i+1]]. All weights are also
+        sorted on mass (along with the protein they belong to), so a sample can be matched
+        against every protein at once with a binary search per peak."""
+        self.weight_values = array('d')
+        self.weight_offsets = array('Q', [0])
+        owners = array('I')
+        for i, prot in enumerate(self.proteins):
+            self.weight_values.extend(prot.weights)
+            self.weight_offsets.append(len(self.weight_values))
+            owners.extend([i] * len(prot.weights))
+        
+        order = sorted(range(len(self.weight_values)), key=self.weight_values.__getitem__)
+        self.sorted_weights = array('d', (self.weight_values[k] for k in order))
+        self.sorted_owners = array('I', (owners[k] for k in order))
+    
+    def array_pairs(self, sample, tolerance=1.2) -> '{protein index: pairs}':
+        """Amount of (peak, weight) pairs within tolerance for every protein with any, using
+        the arrays of build_arrays. See top_shared_peaks."""
+        weights = self.sorted_weights
+        owners = self.sorted_owners
+        pairs = defaultdict(int)
+        for s in sample:
+            for k in range(bisect_left(weights, s - tolerance), bisect_right(weights, s + tolerance)):
+                pairs[owners[k]] += 1
+        return pairs
+    
+    @simple_progress('Building mass index')
+    def build_mass_index(self, bin_width=1.0):
+        """Inverted index from (binned) peptide mass to the proteins containing it. Every
+        bin maps to the exact masses in it and the protein they belong to. Looking up a
+        sample then costs in the order of its size and amount of hits, independent of the
+        size of the database. Doesn't need build_arrays."""
+        self.mass_index_width = bin_width
+        self.mass_index = {}
+        for i, prot in enumerate(self.proteins):
+            for w in prot.weights:
+                b = int(w / bin_width)
+                if b not in self.mass_index:
+                    self.mass_index[b] = (array('d'), array('I'))
+                masses, owners = self.mass_index[b]
+                masses.append(w)
+                owners.append(i)
+    
+    def index_pairs(self, sample, tolerance=1.2) -> '{protein index: pairs}':
+        """Same as array_pairs, using the mass index"""
+        width = self.mass_index_width
+        pairs = defaultdict(int)
+        for s in sample:
+            for b in range(int((s - tolerance) / width), int((s + tolerance) / width) + 1):
+                if b in self.mass_index:
+                    masses, owners = self.mass_index[b]
+                    for k in range(len(masses)):
+                        if abs(masses[k] - s) <= tolerance:
+                            pairs[owners[k]] += 1
+        return pairs
     
     def find_best_proteins(self, sample, amount=10, tolerance=1.2):
         if isinstance(sample, str):
             sample = load_peaks(sample)
+        if self.mass_index is not None:
+            return top_shared_peaks(self.proteins, sample, self.index_pairs(sample, tolerance), amount, tolerance)
+        if self.sorted_weights is not None:
+            return top_shared_peaks(self.proteins, sample, self.array_pairs(sample, tolerance), amount, tolerance)
         scored = ((p, relative_shared_peak(sample, p.weights, tolerance))
                   for p in progress_bar(self.proteins, 'Scoring proteins'))
         return heapq.nlargest(amount, scored, key=lambda t: t[1])
     
+    def find_best_proteins_many(self, samples, amount=10, tolerance=1.2) -> '[[(protein, score)]]':
+        """Scores many samples at once. Without an index or arrays, this does a single
+        pass over the proteins for all samples together."""
+        samples = [load_peaks(s) if isinstance(s, str) else s for s in samples]
+        if self.mass_index is not None or self.sorted_weights is not None:
+            return [self.find_best_proteins(s, amount, tolerance) for s in samples]
+        
+        # Ties are broken on protein index, just like heapq.nlargest does
+        heaps = [[] for s in samples]
+        for i, p in enumerate(progress_bar(self.proteins, 'Scoring proteins')):
+            for sample, heap in zip(samples, heaps):
+                item = (relative_shared_peak(sample, p.weights, tolerance), -i)
+                if len(heap) < amount:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
+        return [[(self.proteins[-i], score) for score, i in sorted(heap, reverse=True)]
+                for heap in heaps]
+    
     def get_peptides(self):
         for prot in progress_bar(self.proteins, 'Loading peptides'):
             yield from prot.chunks
 
 
+def _score_samples(shared, fnames):
+    db, amount, tolerance = shared
+    return [[(p.name, score) for p, score in best]
+            for best in db.find_best_proteins_many(fnames, amount, tolerance)]
+
+
+# Samples per batch when streaming results (see --tsv)
+tsv_batch_size = 16
+
+
+def find_sample_files(paths):
+    """PMF files in paths, which can also be directories"""
+    import os
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if os.path.isfile(os.path.join(path, name)):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
 if __name__ == '__main__':
+    import sys
     import argparse
-    parser = argparse.ArgumentParser(description='MS2 database search')
+    parser = argparse.ArgumentParser(description='MS1 database search (peptide mass fingerprinting)')
     parser.add_argument('-d', '--database', help='FASTA file to use for the database', 
                                             default=ProteinDB.default_file)
+    parser.add_argument('-p', '--pickled', help='File to use to write the database to, pickled. '
+                                                'Overrides the database argument if found.',
+                                           default=None)
+    parser.add_argument('-i', '--index', help='Build a mass index, so samples are scored without '
+                                              'going over every protein',
+                                         action='store_true')
     parser.add_argument('-a', '--amount', help='Amount of results', type=int, default=10)
     parser.add_argument('-t', '--tolerance', help='Tolerance', type=float, default=1.2)
-    parser.add_argument('sample', help='PMF file')
+    parser.add_argument('-w', '--workers', help='Amount of processes to score samples with', type=int, default=1)
+    parser.add_argument('--tsv', help='Stream the results to stdout as tab separated values, as every batch of '
+                                      'samples is done, instead of one table. Hides the progress.',
+                                 action='store_true')
+    parser.add_argument('--stats', help='Print the time, items and process peak memory after every stage',
+                                  action='store_true')
+    parser.add_argument('--stats-file', help='Write the statistics (see --stats) to this file, as JSON', default=None)
+    parser.add_argument('-q', '--quiet', help="Don't show progress", action='store_true')
+    parser.add_argument('samples', help='PMF files, or directories containing them', nargs='+')
     args = parser.parse_args()
-    sample = load_peaks(args.sample)
-    db = ProteinDB(args.database)
-    print_scores(db.find_best_proteins(sample, args), lambda r: r.name[:70],
-                 amount=args.amount, tolerance=args.tolerance)
+    
+    stats.enabled = args.stats or args.stats_file is not None
+    stats.quiet = args.quiet or args.tsv
+    # Keeps the streamed results clean
+    log = sys.stderr if args.tsv else sys.stdout
+    
+    samples = list(find_sample_files(args.samples))
+    
+    save = False
+    if args.pickled is not None:
+        try:
+            db = ProteinDB.load(args.pickled)
+        except Exception as e:
+            print("\nCouldn't load database: {}, creating a new one".format(e), file=log)
+            db = ProteinDB(args.database)
+            save = True
+    else:
+        db = ProteinDB(args.database)
+    
+    if args.index and db.mass_index is None:
+        db.build_mass_index()
+        save = args.pickled is not None
+    if save:
+        db.save(args.pickled)
+    
+    # Every batch of samples is scored in a single pass. Streamed results come in smaller
+    # batches (in order), so they show up while the others are still being scored.
+    if args.tsv:
+        size = tsv_batch_size
+    else:
+        size = max(1, -(-len(samples) // args.workers))
+    batches = [samples[i:i+size] for i in range(0, len(samples), size)]
+    
+    header = ('sample', '#', 'score', 'name')
+    data = [header]
+    if args.tsv:
+        sys.stdout.write('\t'.join(header) + '\n')
+    for batch, scores in pool_map(_score_samples, batches, args.workers, (db, args.amount, args.tolerance)):
+        rows = [(fname, i+1, score, name[:70]) for fname, best in zip(batch, scores)
+                                               for i, (name, score) in enumerate(best)]
+        if args.tsv:
+            sys.stdout.writelines('\t'.join(map(str, row)) + '\n' for row in rows)
+            sys.stdout.flush()
+        else:
+            data += rows
+    
+    if not args.tsv:
+        print('')
+        print(as_rest_table(data))
+    
+    if args.stats:
+        print('', file=log)
+        print(stats.summary(), file=log)
+    if args.stats_file:
+        stats.save(args.stats_file)
 
 
 
@@ -87,3 +304,60 @@ class MS1Test(unittest.TestCase):
         self.assertIn('sp|P07099|HYEP_HUMAN', r.name)
         self.assertAlmostEqual(score, 0.29545454545454547)
 
+    
+    def test_weights(self):
+        import os
+        import tempfile
+        # Chunks with the same composition, in a different order
+        seq = 'DEFGHILMKDEFGHIMLKDEFGHLIMKDEFGHLMIKGARK'
+        with tempfile.NamedTemporaryFile('w', suffix='.fasta', delete=False) as f:
+            f.write('>first\n{}\n'.format(seq))
+        try:
+            (prot,) = ProteinDB(f.name).proteins
+            self.assertEqual(prot.weights, sorted(set(peptide_mass(c) for c in trypsine(0)(seq))))
+            self.assertEqual(len(prot.weights), 3)
+        finally:
+            os.remove(f.name)
+    
+    def test_arrays(self):
+        import os
+        import tempfile
+        with tempfile.NamedTemporaryFile('w', suffix='.fasta', delete=False) as f:
+            f.write('>first\nGARFIELDDEKARPERMEGAK\n>second\nPEPTIDEKLATTERRSPAMR\n'
+                    '>third\nFIELDDEKSPAMRGAR\n')
+        try:
+            db = ProteinDB(f.name, arrays=True)
+            sample = sorted(peptide_mass(c) for c in ('FIELDDEK', 'SPAMR', 'GAR'))
+            best = db.find_best_proteins(sample, amount=4)
+            self.assertEqual([(p.name, score) for p, score in best],
+                             [('third', 1.0), ('first', 0.5), ('second', 0.25)])
+            self.assertEqual(db.find_best_proteins_many([sample], 4), [best])
+            db.build_mass_index(0.5)
+            self.assertEqual(db.find_best_proteins(sample, amount=4), best)
+            db.mass_index = None
+            db.sorted_weights = None
+            self.assertEqual([(p.name, score) for p, score in db.find_best_proteins(sample, 3)],
+                             [(p.name, score) for p, score in best])
+            self.assertEqual(db.find_best_proteins_many([sample, sample[:1]], 3),
+                             [db.find_best_proteins(sample, 3), db.find_best_proteins(sample[:1], 3)])
+        finally:
+            os.remove(f.name)
+    
+    def test_crowded_peaks(self):
+        import os
+        import tempfile
+        with tempfile.NamedTemporaryFile('w', suffix='.fasta', delete=False) as f:
+            f.write('>first\nGARFIELDDEKARPERMEGAK\n>second\nPEPTIDEKLATTERRSPAMR\n'
+                    '>third\nFIELDDEKSPAMRGAR\n>fourth\nGAKGARGGRSPAMR\n')
+        try:
+            db = ProteinDB(f.name)
+            masses = [peptide_mass(c) for c in ('FIELDDEK', 'SPAMR', 'GAR', 'MEGAK')]
+            # Isotopes and peaks between weights, hitting some weights more than once
+            sample = sorted(masses + [m + 1.003 for m in masses] + [m - 0.9 for m in masses] + [400.0, 400.5])
+            best = [(p.name, score) for p, score in db.find_best_proteins(sample, 4)]
+            db.build_arrays()
+            self.assertEqual([(p.name, score) for p, score in db.find_best_proteins(sample, 4)], best)
+            db.build_mass_index(0.5)
+            self.assertEqual([(p.name, score) for p, score in db.find_best_proteins(sample, 4)], best)
+        finally:
+            os.remove(f.name)
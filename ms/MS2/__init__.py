@@ -1,4 +1,4 @@
 
 from .db import ProteinDB2
 from .spectra import ExpMs2Spectrum, TheoMs2Spectrum
-from .scoring import Sequest, SharedPeaks
+from .scoring import Sequest, BinnedSequest, SharedPeaks
@@ -1,62 +1,227 @@
 
+import os
+import sys
+import pickle
 import argparse
 
 from .spectra import *
 from .db import *
 from .scoring import *
+from .parallel import search_spectra
+from .shards import ShardedProteinDB2
+from .output import PsmWriter, output_format, output_formats
 from ms.util import *
 
 parser = argparse.ArgumentParser(description='MS2 database search')
 parser.add_argument('-d', '--database', help='FASTA file to use for the database', 
-                                        default=ProteinDB2.default_file)
+                                        default=None)
 parser.add_argument('-p', '--pickled', help='File to use to write the database to, pickled. '
-                                            'Overrides the database argument if found.',
+                                            'Overrides the database argument if found. '
+                                            'Memory-mapped stores (see --mapped) are detected automatically.',
                                        default=None)
-parser.add_argument('-s', '--scorer', help="Scorer to be used, eval'd. Options are SharedPeaks and Sequest, "
-                                           "both need a first argument of (absolute) tolerance.",
+parser.add_argument('--mapped', help='Write the database (-p) as a memory-mapped store instead of a pickle. '
+                                     'Precomputed spectra and fragment indices are not stored.',
+                                action='store_true')
+parser.add_argument('-s', '--scorer', help="Scorer to be used, eval'd. Options are SharedPeaks, Sequest and BinnedSequest, "
+                                           "all need a first argument of (absolute) tolerance.",
                                       default="Sequest(0.6)")
+parser.add_argument('--out-of-core', help='Build the database (-p) as a memory-mapped store straight from the FASTA '
+                                         'file, with bounded memory. For very large FASTA files. Requires -p, and '
+                                         'only applies when the database is built, not when it is loaded.',
+                                    action='store_true')
+parser.add_argument('--lazy', help='Only digest the peptides within the precursor tolerance of the spectra, in segments, '
+                                   'instead of the whole database. Much faster to start for a few spectra. '
+                                   'With -p, the segments are kept in a pickle for later runs.',
+                              action='store_true')
+parser.add_argument('--add', help='Add the proteins in a FASTA file to the database (-p), without rebuilding it',
+                             action='append', default=[])
+parser.add_argument('--remove', help='Remove the peptides of the proteins in a FASTA file from the database (-p)',
+                                action='append', default=[])
+parser.add_argument('--compact', help='Merge added and removed peptides into the database (-p)',
+                                 action='store_true')
+parser.add_argument('--shards', help='Search the shards in this manifest (see ms.MS2.shards) instead of a database. '
+                                   'Shards without an address are served by local processes.',
+                              default=None)
+parser.add_argument('--top-peaks', help='Only score the N most intense peaks of every spectrum (Eng1994 uses 200)',
+                                   type=int, default=None, metavar='N')
+parser.add_argument('--window-peaks', help='Only score the N most intense peaks in every window of --window-width',
+                                      type=int, default=None, metavar='N')
+parser.add_argument('--window-width', help='Width of the windows of --window-peaks', type=float, default=100.0)
+parser.add_argument('--remove-precursor', help='Remove peaks within this tolerance of the precursor before scoring',
+                                          type=float, default=None, metavar='TOLERANCE')
+parser.add_argument('--min-intensity', help='Remove peaks below this fraction of the most intense peak before scoring',
+                                       type=float, default=None, metavar='FRACTION')
+parser.add_argument('--shard-authkey', help='Shared secret of the shard servers in the manifest (see --shards). '
+                                          'Local servers get a random one.',
+                                     default=None)
 parser.add_argument('-a', '--amount', help='Amount of results', type=int, default=10)
+parser.add_argument('-t', '--pep-tolerance', help='Tolerance on the precursor mass', type=float, default=None)
+parser.add_argument('--fragment-index', help='Build a fragment index, only supported by SharedPeaks. '
+                                             'Makes wide precursor tolerances (open search) feasible, '
+                                             'with the same results.',
+                                        action='store_true')
+parser.add_argument('--precompute', help='Compute all theoretical spectra once, when building the database',
+                                     action='store_true')
+parser.add_argument('--sweep', help='Sort all spectra on precursor mass and sweep them over the database, '
+                                  'so candidates shared by neighbouring spectra are only made once. '
+                                  'All spectra are loaded in memory, and -w and --pipeline are not supported.',
+                             action='store_true')
+parser.add_argument('--pipeline', help='Parse spectra, search them and write results in separate threads, connected by '
+                                     'bounded queues, so reading and writing overlap with searching. '
+                                     'Works best with --workers, as only one thread at a time runs Python code.',
+                                action='store_true')
+parser.add_argument('-w', '--workers', help='Amount of processes to score spectra with', type=int, default=1)
+parser.add_argument('-o', '--output', help='Stream the results to this file as they come, one line per peptide-spectrum match, '
+                                           'instead of printing tables. "-" is the standard output.',
+                                      default=None)
+parser.add_argument('--output-format', help='Format of the output file, guessed from its extension by default '
+                                            '(JSON lines for .json and .jsonl, TSV otherwise)',
+                                       choices=output_formats, default=None)
+parser.add_argument('--stats', help='Print the time, items and process peak memory after every stage, and the slowest spectra',
+                              action='store_true')
+parser.add_argument('--stats-file', help='Write the statistics (see --stats) to this file, as JSON', default=None)
+parser.add_argument('-q', '--quiet', help="Don't show progress", action='store_true')
 parser.add_argument('sample', help='MS2 spectra file, MGF format')
 args = parser.parse_args()
+# A lazy database (-p) has to be used with the FASTA file it was made from, if one is given
+database_given = args.database is not None
+args.database = args.database or ProteinDB2.default_file
+if args.shards and (args.pickled or args.add or args.remove or args.compact or args.fragment_index
+                    or args.precompute or args.sweep or args.workers > 1):
+    parser.error('--shards only works with -s, -a, -t and the output options')
+if args.lazy and (args.shards or args.mapped or args.out_of_core or args.add or args.remove or args.compact
+                  or args.fragment_index or args.precompute):
+    parser.error("--lazy doesn't work with other kinds of databases, or updating them")
+if args.sweep and (args.workers > 1 or args.pipeline):
+    parser.error("--sweep searches all spectra at once in this process, it doesn't work with -w or --pipeline")
+if args.out_of_core and args.pickled is None:
+    parser.error('--out-of-core builds the store given with -p')
 
-sample = ExpMs2Spectrum.load_spectra(args.sample)
+stats.enabled = args.stats or args.stats_file is not None
+# Progress would end up in between the results, and other messages go to stderr
+stats.quiet = args.quiet or args.output == '-'
+log = sys.stderr if args.output == '-' else sys.stdout
+
+sample = ExpMs2Spectrum.iter_spectra(args.sample)
+if args.pipeline:
+    # The thread only starts with the search, after the workers (-w) are forked
+    sample = prefetch(sample)
 
 use_pickle = (args.pickled is not None)
 save = False
 
-if use_pickle:
+if args.shards:
+    db = ShardedProteinDB2.load(args.shards, args.shard_authkey and args.shard_authkey.encode())
+elif args.lazy:
+    # Only a file that doesn't exist yet is (re)created, anything else is never saved over
+    if use_pickle and os.path.exists(args.pickled):
+        try:
+            db = LazyProteinDB2.load(args.pickled)
+        except (ValueError, EOFError, pickle.UnpicklingError) as e:
+            sys.exit("Can't use {} as a lazy database: {}".format(args.pickled, e))
+        if database_given and db.fname != os.path.abspath(args.database):
+            sys.exit("{} was made from {}, not {}".format(args.pickled, db.fname, args.database))
+    else:
+        db = LazyProteinDB2(args.database)
+elif use_pickle:
     try:
         db = ProteinDB2.load(args.pickled)
         save = False
     except Exception as e:
-        print("\nCouldn't load database: {}, creating a new one".format(e))
-        save = True
-        db = ProteinDB2(args.database)
+        print("\nCouldn't load database: {}, creating a new one".format(e), file=log)
+        if args.out_of_core:
+            build_peptide_store(args.database, args.pickled)
+            db = ProteinDB2.load(args.pickled)
+            if args.precompute:
+                db.precompute_spectra()
+        else:
+            save = True
+            db = ProteinDB2(args.database, precompute=args.precompute)
+    else:
+        if args.precompute and db.fragments is None:
+            db.precompute_spectra()
+            save = save or not isinstance(db, MappedProteinDB2)
 else:
-    db = ProteinDB2(args.database)
+    db = ProteinDB2(args.database, precompute=args.precompute)
+
+for fname in args.add:
+    db.add_fasta(fname)
+for fname in args.remove:
+    db.remove_fasta(fname)
+if args.compact and db.delta:
+    db.compact()
+if args.add or args.remove or args.compact:
+    save = save or use_pickle
+
+if args.fragment_index and db.fragment_index is None:
+    db.build_fragment_index()
+    # Stores don't keep the fragment index, but may still have to save their delta
+    save = save or (use_pickle and not isinstance(db, MappedProteinDB2))
+
+# Stores are always saved as stores
+mapped = args.mapped or isinstance(db, MappedProteinDB2)
+
+if args.pep_tolerance is not None:
+    db.pep_tolerance = args.pep_tolerance
+
+if isinstance(db, LazyProteinDB2):
+    # All segments the spectra need are digested in a single pass
+    sample = list(sample)
+    loaded = len(db.segments)
+    db.prepare(sample)
+    save = use_pickle and len(db.segments) > loaded
 
 try:
     sp = eval(args.scorer)
-    results = []
-    for espec in progress_bar(sample, 'Calculating scores'):
-        results.append((espec, db.find_best_peptides(espec, sp, amount=args.amount)))
+    if (args.top_peaks, args.window_peaks, args.remove_precursor, args.min_intensity) != (None,)*4:
+        sp.peak_filter = PeakFilter(args.top_peaks, args.window_peaks, args.window_width,
+                                    args.remove_precursor, args.min_intensity)
+    if args.sweep:
+        results = db.sweep_search(sample, sp, args.amount)
+    elif args.shards:
+        results = db.search(sample, sp, args.amount)
+    else:
+        # This starts the workers, so before any thread of the pipeline
+        results = search_spectra(db, sample, sp, args.amount, args.workers)
+        if args.pipeline:
+            results = prefetch(results)
+        results = progress_bar(results, 'Calculating scores')
     
-    print("")
-    print("Results")
-    print("=======")
-    print("")
-    
-    for espec, scores in results:
-        print(espec.title)
-        print('-' * len(espec.title))
-        print('')
-        print_scores(scores)
-        print('\n')
+    if args.output is not None:
+        # Results are written as they come, so nothing is lost if the search is interrupted
+        f = sys.stdout if args.output == '-' else open(args.output, 'w')
+        try:
+            with PsmWriter(f, args.output_format or output_format(args.output)) as writer:
+                for espec, scores in results:
+                    writer.write(espec, scores)
+        finally:
+            if f is not sys.stdout:
+                f.close()
+    else:
+        results = list(results)
+        print("")
+        print("Results")
+        print("=======")
+        print("")
+        
+        for espec, scores in results:
+            print(espec.title)
+            print('-' * len(espec.title))
+            print('')
+            print_scores(scores)
+            print('\n')
     
 except Exception as e:
     if save:
-        db.save(args.pickled)
+        db.save(args.pickled, mapped=mapped)
     raise e
 
 if save:
-    db.save(args.pickled)
+    db.save(args.pickled, mapped=mapped)
+if args.shards:
+    db.close()
+
+if args.stats:
+    print(stats.summary(), file=log)
+if args.stats_file:
+    stats.save(args.stats_file)
@@ -1,26 +1,44 @@
 """Contains the MS2 database and some ionization code
 """
 
+import os
 import heapq
+import pickle
+from array import array
+from collections import deque
 from itertools import chain
 
 from ms.util import *
-from ms.MS1 import ProteinDB
 from .spectra import *
+from .index import FragmentIndex
+from .store import *
 
 
 def create_ion(_extra_mass, reverse):
     '''Creates a function that returns the masses of the fragments 
     after MS2 fragmentation by some type of ion.'''
     
+    # Running sums, so a peptide costs a linear amount of dictionary lookups
     if reverse:
         def ion(seq, extra_mass=_extra_mass):
-            return [sum(amino_weights[c] for c in seq[i:]) + extra_mass
-                    for i in range(len(seq)-1, -1, -1)]
+            masses = []
+            total = 0.0
+            for c in reversed(seq):
+                total += amino_weights[c]
+                masses.append(total + extra_mass)
+            return masses
     else:
         def ion(seq, extra_mass=_extra_mass):
-            return [sum(amino_weights[c] for c in seq[:i]) + extra_mass
-                    for i in range(1, len(seq)+1)]
+            masses = []
+            total = 0.0
+            for c in seq:
+                total += amino_weights[c]
+                masses.append(total + extra_mass)
+            return masses
+    
+    # Needed by Ionizer.ladders, which computes all ions from a single prefix sum
+    ion.extra_mass = _extra_mass
+    ion.reverse = reverse
     return ion
 
 
@@ -34,50 +52,778 @@ class Ionizer:
         self.ions = ions
     
     def __call__(self, seq):
-        return sum((ion(seq) for ion in self.ions), [])
+        peaks = []
+        for ion in self.ions:
+            peaks.extend(ion(seq))
+        return peaks
+    
+    def ladders(self, seqs) -> '(array, array)':
+        """Ionizes a batch of peptides at once (only works for ions made by `create_ion`).
+        Returns a flat buffer of fragment masses and a buffer of offsets, so that the
+        (sorted) peaks of ``seqs[k]`` are ``peaks[offsets[k]:offsets[k+1]]``.
+        """
+        
+        if not isinstance(seqs, list):
+            seqs = list(seqs)
+        
+        offsets = array('Q', bytes(8 * (len(seqs)+1)))
+        total = 0
+        longest = 0
+        for k, seq in enumerate(seqs):
+            total += len(self.ions) * len(seq)
+            offsets[k+1] = total
+            longest = max(longest, len(seq))
+        
+        peaks = array('d', bytes(8 * total))
+        prefix = array('d', bytes(8 * (longest+1)))
+        for k, seq in enumerate(seqs):
+            n = len(seq)
+            acc = 0.0
+            for i, c in enumerate(seq, 1):
+                acc += amino_weights[c]
+                prefix[i] = acc
+            
+            start = pos = offsets[k]
+            for ion in self.ions:
+                extra_mass = ion.extra_mass
+                if ion.reverse:
+                    for i in range(n-1, -1, -1):
+                        peaks[pos] = (acc - prefix[i]) + extra_mass
+                        pos += 1
+                else:
+                    for i in range(1, n+1):
+                        peaks[pos] = prefix[i] + extra_mass
+                        pos += 1
+            
+            # Every ion is already ascending, so this is (nearly) a linear merge
+            peaks[start:pos] = array('d', sorted(peaks[start:pos]))
+        
+        return peaks, offsets
     
 # Ionizer can't be pickled, so for now we just use a default one
 Ionizer.default = Ionizer()
 
 
+# Bounds (see `Scorer`) are computed with a slightly larger tolerance, and compared
+# with some slack, so rounding can't make them too tight
+bound_slack = 1e-9
+
+
+def best_scores(tspecs, espec, scorer, amount=10) -> '[(name, score)]':
+    """The same as heapq.nlargest(amount, ((tspec.title, scorer.score(tspec, espec)) ...)),
+    but uses the upper_bound of the scorer (if any) to skip candidates that can't beat
+    the current k-th best score."""
+    upper_bound = getattr(scorer, 'upper_bound', None)
+    if upper_bound is None or amount <= 0:
+        return heapq.nlargest(amount, ((tspec.title, scorer.score(tspec, espec)) for tspec in tspecs),
+                              key=lambda t: t[1])
+    
+    # Ties are won by earlier candidates (like nlargest), so (score, -order) decides
+    heap = []
+    for order, tspec in enumerate(tspecs):
+        if len(heap) == amount:
+            worst = heap[0][0]
+            bound = upper_bound(tspec, espec)
+            if bound + bound_slack*(abs(bound) + 1) < worst:
+                continue
+        item = (scorer.score(tspec, espec), -order, tspec.title)
+        if len(heap) < amount:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+    return [(title, score) for score, order, title in sorted(heap, reverse=True)]
+
+
 class ProteinDB2(Pickled):
     #default_file = data_loc('uniprot-human-reviewed-trypsin-november-2016-small.fasta')
     default_file = data_loc('uniprot-human-reviewed-trypsin-november-2016.fasta')
     
-    def __init__(self, fname=None, missed_cleavages=1, pep_tolerance=1.2):
+    # Flat buffers with the sorted fragment masses of every peptide, in the same order
+    # as self.peptides (see Ionizer.ladders). None unless precompute_spectra was called.
+    fragments = None
+    fragment_offsets = None
+    fragment_index = None
+    
+    # Peptides added or removed since the database was built, as {peptide: flags},
+    # where flags 0 means removed (see add_fasta and remove_fasta). The flags follow from
+    # delta_counts, {peptide: (targets, decoys)}: how many times the peptide was added as
+    # a target and as a decoy, minus how many times it was removed.
+    delta = None
+    delta_counts = None
+    _delta_peptides = None
+    missed_cleavages = 1
+    
+    def __init__(self, fname=None, missed_cleavages=1, pep_tolerance=1.2, precompute=False):
         fname = fname or self.default_file
         self.pep_tolerance = pep_tolerance
+        self.missed_cleavages = missed_cleavages
         
         # So far we don't do extensive analysis on the level of peptides.
         # Specifically, no analysis of the target/decoy kind is done. 
         # For simplicity, we leave peptides as simple strings and store
         # the target/decoy info in sets (which are blazingly fast anyway)
-        target_prot = ProteinDB(fname, missed_cleavages)
-        self.targets = set(target_prot.get_peptides())
-        decoy_prot = ProteinDB(fname, missed_cleavages, reverse=True)
-        self.decoys = set(decoy_prot.get_peptides())
-        print(progress_start.format('Forming peptide list'), end='')
-        self.peptides = SortedCollection(self.targets | self.decoys, key=peptide_mass)
-        print(progress_end.format('Forming peptide list'))
+        self.targets = set()
+        self.decoys = set()
+        
+        # The FASTA file is read only once, and every protein is digested forwards (targets)
+        # and in reverse (decoys) right away. None of the MS1 data (weights) is needed.
+        chunker = trypsine(missed_cleavages)
+        for prot in progress_bar(read_fasta(fname), 'Loading proteins'):
+            self.targets.update(chunker(prot.seq))
+            self.decoys.update(chunker(prot.seq[::-1]))
+        
+        with progress('Forming peptide list') as stage:
+            self.peptides = SortedCollection(chain(self.targets, (p for p in self.decoys if p not in self.targets)),
+                                             key=peptide_mass)
+            stage.items = len(self.peptides)
+        
+        if precompute:
+            self.precompute_spectra()
+    
+    @simple_progress('Precomputing theoretical spectra')
+    def precompute_spectra(self):
+        """Ionizes every peptide once, so queries don't have to build the same
+        theoretical spectra over and over again. The buffers are saved along with
+        the database."""
+        self.fragments, self.fragment_offsets = Ionizer.default.ladders(self.peptides)
+    
+    def build_fragment_index(self, bin_width=0.1):
+        """Builds a FragmentIndex over all peptides. Scorers that support it (see
+        `SharedPeaks.index_bounds`) then no longer scan every candidate, which makes
+        wide precursor tolerances (open search) feasible."""
+        if self.fragments is None:
+            self.precompute_spectra()
+        self.fragment_index = FragmentIndex(self.fragments, self.fragment_offsets, bin_width)
     
     def find_best_proteins(self, sample: list, amount=10):
         raise NotImplemented("Protein inference isn't implemented")
     
+    @classmethod
+    def load(cls, fname):
+        if is_peptide_store(fname):
+            return MappedProteinDB2(fname)
+        return super().load(fname)
+    
+    def save(self, fname=None, mapped=False):
+        """With mapped, only the peptides are written, as a memory-mapped store
+        (see ms.MS2.store) which is a lot faster to load than a pickle."""
+        if not mapped:
+            return super().save(fname)
+        fname = fname or self._loaded_from
+        with progress('Saving {} to {}'.format(type(self).__name__, fname)):
+            write_peptide_store(fname, self.store_records(), self.pep_tolerance)
+    
+    def store_records(self) -> '[(mass, peptide, flags)]':
+        """All peptides, sorted on (mass, peptide), including the delta"""
+        if not self.delta:
+            return self.base_records()
+        base = (r for r in self.base_records() if r[1] not in self.delta)
+        added = self.delta_peptides()
+        return heapq.merge(base, ((added.key_at(k), pep, self.delta[pep]) for k, pep in enumerate(added)))
+    
+    def base_records(self):
+        for k, pep in enumerate(self.peptides):
+            yield self.peptides.key_at(k), pep, self.base_flags(pep)
+    
+    def base_flags(self, pep):
+        """TARGET and/or DECOY, or 0 if the peptide isn't in the database (ignoring the delta)"""
+        return (TARGET if pep in self.targets else 0) | (DECOY if pep in self.decoys else 0)
+    
+    def flags(self, pep):
+        if self.delta and pep in self.delta:
+            return self.delta[pep]
+        return self.base_flags(pep)
+    
+    def is_target(self, k):
+        """Whether the peptide at index k is a target (if not, it's a decoy)"""
+        return self.peptides[k] in self.targets
+    
+    # Incremental updates
+    # -------------------
+    
+    def add_fasta(self, fname, missed_cleavages=None):
+        """Adds the proteins in a FASTA file (e.g. contaminants) without rebuilding the
+        database. The peptides go to a delta, which queries merge with the rest of the
+        database, until `compact` is called."""
+        for pep, flag in digest_fasta(fname, missed_cleavages or self.missed_cleavages):
+            self._change(pep, flag, 1)
+    
+    def remove_fasta(self, fname, missed_cleavages=None):
+        """Removes the proteins in a FASTA file, undoing add_fasta. Peptides that are still
+        added by other FASTA files stay. The database itself only knows its peptides, not
+        how many proteins have them, so removing a protein it was built with also removes
+        the peptides it shares with other proteins of the database."""
+        for pep, flag in digest_fasta(fname, missed_cleavages or self.missed_cleavages):
+            self._change(pep, flag, -1)
+    
+    def _change(self, pep, flag, amount):
+        if self.delta is None:
+            self.delta, self.delta_counts = {}, {}
+        targets, decoys = self.delta_counts.get(pep, (0, 0))
+        if flag & TARGET:
+            targets += amount
+        if flag & DECOY:
+            decoys += amount
+        
+        flags = base = self.base_flags(pep)
+        for count, f in ((targets, TARGET), (decoys, DECOY)):
+            if count > 0:
+                flags |= f
+            elif count < 0:
+                flags &= ~f
+        
+        if (targets, decoys) == (0, 0):
+            self.delta_counts.pop(pep, None)
+        else:
+            self.delta_counts[pep] = (targets, decoys)
+        if flags == base:
+            self.delta.pop(pep, None)
+        else:
+            self.delta[pep] = flags
+        self._delta_peptides = None
+    
+    def delta_peptides(self) -> SortedCollection:
+        """Added (or changed) peptides, sorted like self.peptides. Made lazily."""
+        if self._delta_peptides is None:
+            self._delta_peptides = SortedCollection((p for p, flags in self.delta.items() if flags),
+                                                    key=peptide_mass)
+        return self._delta_peptides
+    
+    @simple_progress('Compacting database')
+    def compact(self):
+        """Merges the delta into the rest of the database"""
+        if not self.delta:
+            self.delta = self.delta_counts = self._delta_peptides = None
+            return
+        for pep, flags in self.delta.items():
+            (self.targets.add if flags & TARGET else self.targets.discard)(pep)
+            (self.decoys.add if flags & DECOY else self.decoys.discard)(pep)
+        self.peptides = SortedCollection(chain(self.targets, (p for p in self.decoys if p not in self.targets)),
+                                         key=peptide_mass)
+        self.delta = self.delta_counts = self._delta_peptides = None
+        if self.fragments is not None:
+            self.precompute_spectra()
+        if self.fragment_index is not None:
+            self.build_fragment_index(self.fragment_index.bin_width)
+    
+    # Searching
+    # ---------
+    
+    def title(self, k):
+        tag = 'TARGET' if self.is_target(k) else 'DECOY '
+        return tag + ' ' + self.peptides[k]
+    
+    def candidate_range(self, espec) -> '(start, end)':
+        """Indices of the peptides within the precursor tolerance of the spectrum"""
+        return self.peptides.index_between(espec.pepmass - self.pep_tolerance,
+                                           espec.pepmass + self.pep_tolerance)
+    
+    def theoretical_spectra(self, start, end) -> '[TheoMs2Spectrum]':
+        """Theoretical spectra of the peptides with index start up to (not including) end"""
+        if self.fragments is not None:
+            peaks, offsets, first = self.fragments, self.fragment_offsets, 0
+        else:
+            peaks, offsets = Ionizer.default.ladders(self.peptides[k] for k in range(start, end))
+            first = start
+        
+        for k in range(start, end):
+            yield TheoMs2Spectrum(title = self.title(k),
+                                  pepmass = self.peptides.key_at(k),
+                                  peaks = peaks[offsets[k-first]:offsets[k-first+1]],
+                                  presorted = True)
+    
+    def candidate_spectra(self, espec) -> '[TheoMs2Spectrum]':
+        """Theoretical spectra of all peptides within the precursor tolerance"""
+        start, end = self.candidate_range(espec)
+        if not self.delta:
+            return self.theoretical_spectra(start, end)
+        
+        # Merge with the delta, in the order a rebuilt database would have
+        base = ((self.peptides.key_at(k), self.peptides[k], tspec)
+                for k, tspec in zip(range(start, end), self.theoretical_spectra(start, end))
+                if self.peptides[k] not in self.delta)
+        added = self.delta_peptides().find_between(espec.pepmass - self.pep_tolerance,
+                                                   espec.pepmass + self.pep_tolerance)
+        added = ((peptide_mass(pep), pep, TheoMs2Spectrum(title = ('TARGET ' if self.delta[pep] & TARGET else 'DECOY  ') + pep,
+                                                          pepmass = peptide_mass(pep),
+                                                          peaks = Ionizer.default(pep)))
+                 for pep in added)
+        return (tspec for mass, pep, tspec in heapq.merge(base, added, key=lambda t: t[:2]))
+    
     def peptide_scores(self, espec, scorer) -> '[(name, score)]':
         espec = scorer.preprocess_espec(espec)
         
-        # First, filter on peptide mass
-        candidate_peptides = self.peptides.find_between(espec.pepmass - self.pep_tolerance,
-                                                        espec.pepmass + self.pep_tolerance)
-        
-        # Then, determine tandem scores
-        for pep in candidate_peptides:
-            tag = 'TARGET' if pep in self.targets else 'DECOY '
-            tspec = TheoMs2Spectrum(title = tag + ' ' + pep,
-                                    pepmass = peptide_mass(pep),
-                                    peaks = Ionizer.default(pep))
+        # First, filter on peptide mass. Then, determine tandem scores
+        candidates = 0
+        for tspec in self.candidate_spectra(espec):
+            candidates += 1
             yield (tspec.title, scorer.score(tspec, espec))
+        stats.record('Spectra', title=espec.title, candidates=candidates)
+    
+    def indexed_peptide_scores(self, espec, scorer, amount=10) -> '[(name, score)]':
+        """Uses the fragment index to find the best peptides, without looking at candidates
+        that have no fragment in common with the spectrum. The others are scored best
+        bound first (see `Scorer`), until none of them can make it."""
+        espec = scorer.preprocess_espec(espec)
+        start, end = self.candidate_range(espec)
+        if amount <= 0:
+            return []
+        bounds = scorer.index_bounds(self.fragment_index, espec, start, end)
+        
+        # Ties are won by earlier candidates, just like a full scan
+        heap = []
+        for k in sorted(bounds, key=lambda k: (-bounds[k], k)):
+            if len(heap) == amount and bounds[k] + bound_slack*(abs(bounds[k]) + 1) < heap[0][0]:
+                break
+            tspec, = self.theoretical_spectra(k, k+1)
+            item = (scorer.score(tspec, espec), -k)
+            if len(heap) < amount:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+        best = [(-k, score) for score, k in sorted(heap, reverse=True) if score > 0]
+        
+        # The other candidates score 0, a full scan would still report them
+        scored = {k for k, score in best}
+        k = start
+        while len(best) < amount and k < end:
+            if k not in scored:
+                best.append((k, 0))
+            k += 1
+        
+        return [(self.title(k), score) for k, score in best]
+    
+    def sweep_search(self, spectra, scorer, amount=10) -> '[(espec, [(name, score)])]':
+        """Searches all spectra at once, like find_best_peptides. Spectra are visited in
+        order of precursor mass, so their candidate windows slide over the peptides like a
+        merge join: every theoretical spectrum is made only once, and then reused by all
+        spectra whose window overlaps it. Results are in the original order."""
+        spectra = list(spectra)
+        if self.delta or (self.fragment_index is not None and hasattr(scorer, 'index_bounds')):
+            return [(espec, self.find_best_peptides(espec, scorer, amount)) for espec in spectra]
+        
+        results = [None] * len(spectra)
+        window = deque()  # (index, tspec) of the peptides in the current window
+        window_end = 0
+        for i in progress_bar(sorted(range(len(spectra)), key=lambda i: spectra[i].pepmass),
+                              'Calculating scores'):
+            espec = scorer.preprocess_espec(spectra[i])
+            start, end = self.candidate_range(espec)
+            while window and window[0][0] < start:
+                window.popleft()
+            
+            window_end = max(window_end, start)
+            window.extend(zip(range(window_end, end), self.theoretical_spectra(window_end, end)))
+            window_end = max(window_end, end)
+            
+            tspecs = (tspec for k, tspec in window if k < end)
+            with stats.timed('Spectra', title=espec.title, candidates=end - start):
+                results[i] = (spectra[i], best_scores(tspecs, espec, scorer, amount))
+        return results
+    
+    def find_best_peptides(self, tspec, scorer, amount=10):
+        # Candidates are the peptides within the precursor tolerance, ignoring the delta
+        with stats.timed('Spectra', title=tspec.title) as row:
+            if stats.enabled:
+                start, end = self.candidate_range(tspec)
+                row['candidates'] = end - start
+            
+            # The fragment index doesn't know about the delta
+            if self.fragment_index is not None and hasattr(scorer, 'index_bounds') and not self.delta:
+                return self.indexed_peptide_scores(tspec, scorer, amount)
+            espec = scorer.preprocess_espec(tspec)
+            return best_scores(self.candidate_spectra(espec), espec, scorer, amount)
+
+
+class MappedProteinDB2(ProteinDB2):
+    """A ProteinDB2 backed by a memory-mapped peptide store, as returned by
+    `ProteinDB2.load`. The peptides only have target/decoy flags, the sets
+    targets and decoys aren't available."""
+    
+    targets = None
+    decoys = None
+    
+    def __init__(self, fname, pep_tolerance=None):
+        with progress('Mapping {} from {}'.format(type(self).__name__, fname)):
+            self.peptides = MappedPeptides(fname)
+            self.pep_tolerance = pep_tolerance or self.peptides.pep_tolerance
+            self._loaded_from = fname
+            
+            # The delta is kept next to the store, so updates don't rewrite the whole store
+            if os.path.exists(self.delta_file):
+                with open(self.delta_file, 'rb') as f:
+                    self.delta, self.delta_counts = pickle.load(f)
+    
+    @property
+    def delta_file(self):
+        return self.peptides.fname + '.delta'
+    
+    def save(self, fname=None, mapped=True):
+        """Saving to the store this was loaded from only writes the delta"""
+        if not mapped:
+            raise ValueError("A mapped database can only be saved as a store")
+        if fname is not None and os.path.abspath(fname) != self.peptides.fname:
+            return super().save(fname, mapped)
+        
+        if self.delta_counts:
+            with open(self.delta_file, 'wb') as f:
+                pickle.dump((self.delta, self.delta_counts), f, pickle.HIGHEST_PROTOCOL)
+        elif os.path.exists(self.delta_file):
+            os.remove(self.delta_file)
+    
+    @simple_progress('Compacting database')
+    def compact(self):
+        if self.delta:
+            write_peptide_store(self.peptides.fname, self.store_records(), self.pep_tolerance)
+            self.peptides = MappedPeptides(self.peptides.fname)
+        self.delta = self.delta_counts = self._delta_peptides = None
+        self.save()
+    
+    def base_records(self):
+        for k, pep in enumerate(self.peptides):
+            yield self.peptides.key_at(k), pep, self.peptides.flags(k)
+    
+    def base_flags(self, pep):
+        return self.peptides.flags_of(pep)
+    
+    def is_target(self, k):
+        return self.peptides.is_target(k)
+
+
+def _file_stamp(fname) -> '(size, modification time)':
+    """Changes when the file does, None if it doesn't exist"""
+    try:
+        st = os.stat(fname)
+    except FileNotFoundError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+class LazyProteinDB2(ProteinDB2):
+    """A ProteinDB2 that only holds the peptides in the segments of precursor mass (of
+    segment_width) that queries need. Missing segments are digested from the FASTA
+    file, and kept for later queries (also when the database is pickled). The first
+    pass digests the whole file, and notes where the peptides of every segment are, so
+    later passes only read those. Indices (as in candidate_range) change when segments
+    are added.
+    
+    Precomputed spectra, fragment indices and incremental updates aren't supported.
+    """
+    
+    targets = None
+    decoys = None
+    
+    # The peptides of every segment, as flat (protein code, start, end) triples, and the
+    # byte offsets of every protein in the FASTA file (see read_fasta). None until the
+    # first pass. fasta_stamp tells whether the FASTA file changed since.
+    segment_spans = None
+    protein_offsets = None
+    fasta_stamp = None
+    
+    def __init__(self, fname=None, missed_cleavages=1, pep_tolerance=1.2, segment_width=100.0):
+        self.fname = os.path.abspath(fname or self.default_file)
+        self.missed_cleavages = missed_cleavages
+        self.pep_tolerance = pep_tolerance
+        self.segment_width = segment_width
+        # Sorted (mass, peptide, flags) records of every loaded segment
+        self.segments = {}
+        self.peptides = PeptideList()
+    
+    @classmethod
+    def load(cls, fname):
+        db = super().load(fname)
+        if not isinstance(db, LazyProteinDB2) or not hasattr(db, 'segments'):
+            raise ValueError('{} is not a lazy database'.format(fname))
+        if db.fasta_stamp is not None and db.fasta_stamp != _file_stamp(db.fname):
+            raise ValueError('{} has changed since {} was made from it'.format(db.fname, fname))
+        return db
+    
+    def save(self, fname=None, mapped=False):
+        if mapped:
+            raise ValueError("A lazy database only has some of the peptides, it can't be saved as a store")
+        return super().save(fname)
+    
+    def segments_of(self, espec) -> range:
+        """Segments covering the precursor tolerance of the spectrum"""
+        return range(int((espec.pepmass - self.pep_tolerance) // self.segment_width),
+                     int((espec.pepmass + self.pep_tolerance) // self.segment_width) + 1)
+    
+    def prepare(self, spectra):
+        """Makes sure the segments of all spectra are loaded, in (at most) one pass"""
+        missing = {s for espec in spectra for s in self.segments_of(espec) if s not in self.segments}
+        if missing:
+            self.load_segments(missing)
+    
+    def load_segments(self, segments):
+        width = self.segment_width
+        found = {s: {} for s in segments}
+        
+        def add(pep, flag):
+            mass = peptide_mass(pep)
+            peptides = found.get(mass // width)
+            if peptides is not None:
+                peptides[pep] = mass, peptides.get(pep, (mass, 0))[1] | flag
+        
+        with open(self.fname, 'rb') as f:
+            if self.segment_spans is None:
+                self._index_fasta(f, found, add)
+            else:
+                # Only the peptides of the segments are read, as (protein, start, end)
+                offsets = self.protein_offsets
+                spans = sorted(chain.from_iterable(zip(*[iter(self.segment_spans.get(s, ()))] * 3)
+                                                   for s in segments))
+                last = None
+                for code, start, end in progress_bar(spans, 'Loading peptides'):
+                    if code != last:
+                        i = code >> 1
+                        seq = fasta_sequence(f, offsets[2*i], offsets[2*i+1])
+                        seq = seq[::-1] if code & 1 else seq
+                        last = code
+                    add(seq[start:end], DECOY if code & 1 else TARGET)
+        
+        with progress('Forming peptide list') as stage:
+            for s, peptides in found.items():
+                self.segments[s] = sorted((mass, pep, flags) for pep, (mass, flags) in peptides.items())
+            self.peptides = PeptideList(chain.from_iterable(self.segments[s] for s in sorted(self.segments)),
+                                        self.pep_tolerance)
+            stage.items = len(self.peptides)
+    
+    def _index_fasta(self, f, found, add):
+        """Digests all proteins, adding the peptides of the segments in found, and notes
+        where the peptides of every segment are"""
+        width = self.segment_width
+        chunker = trypsine(self.missed_cleavages)
+        slack = 1e-6
+        self.fasta_stamp = _file_stamp(self.fname)
+        self.protein_offsets = array('Q')
+        spans = {}
+        for i, (name, start, end) in enumerate(progress_bar(read_fasta(self.fname, offsets=True),
+                                                            'Loading proteins')):
+            self.protein_offsets.extend((start, end))
+            prot_seq = fasta_sequence(f, start, end)
+            # Decoys are spans of the reversed protein, with an odd code
+            for seq, flag, code in ((prot_seq, TARGET, 2*i), (prot_seq[::-1], DECOY, 2*i + 1)):
+                for start, end, mass in chunker.digest(seq):
+                    # Masses from prefix sums can be off by a rounding error, so peptides
+                    # close to the edge of a segment are in both, and get the exact mass
+                    low, high = int((mass - slack) // width), int((mass + slack) // width)
+                    if low not in spans:
+                        spans[low] = array('I')
+                    spans[low].extend((code, start, end))
+                    if high != low:
+                        if high not in spans:
+                            spans[high] = array('I')
+                        spans[high].extend((code, start, end))
+                    if low in found or high in found:
+                        add(seq[start:end], flag)
+        self.segment_spans = spans
+    
+    def base_flags(self, pep):
+        return self.peptides.flags_of(pep)
+    
+    def is_target(self, k):
+        return self.peptides.is_target(k)
+    
+    def precompute_spectra(self):
+        raise ValueError("A lazy database can't precompute spectra")
+    
+    def _change(self, pep, flag, amount):
+        raise ValueError("A lazy database can't be updated, it reads its FASTA file when needed")
+    
+    # Searching makes sure the segments are loaded first
+    
+    def peptide_scores(self, espec, scorer):
+        self.prepare([espec])
+        return super().peptide_scores(espec, scorer)
+    
+    def sweep_search(self, spectra, scorer, amount=10):
+        spectra = list(spectra)
+        self.prepare(spectra)
+        return super().sweep_search(spectra, scorer, amount)
     
     def find_best_peptides(self, tspec, scorer, amount=10):
-        return heapq.nlargest(amount, self.peptide_scores(tspec, scorer), key=lambda t: t[1])
+        self.prepare([tspec])
+        return super().find_best_peptides(tspec, scorer, amount)
+
+
+
+# Tests
+
+import unittest
+
+class IonizerTest(unittest.TestCase):
+    def test_ladders(self):
+        seqs = ['GAR', 'FIELDDEK', 'ARPER', 'K']
+        peaks, offsets = Ionizer.default.ladders(seqs)
+        self.assertEqual(len(offsets), len(seqs)+1)
+        for k, seq in enumerate(seqs):
+            expected = sorted(Ionizer.default(seq))
+            found = peaks[offsets[k]:offsets[k+1]]
+            self.assertEqual(len(found), len(expected))
+            for f, e in zip(found, expected):
+                self.assertAlmostEqual(f, e)
+    
+    def test_ions(self):
+        self.assertAlmostEqual(b_ion('GAR')[0], amino_weights['G'] + proton)
+        self.assertAlmostEqual(y_ion('GAR')[-1], peptide_mass('GAR'))
+
 
+class FastaTestCase(unittest.TestCase):
+    """Writes a small FASTA file, and a spectrum of one of its peptides"""
+    
+    def setUp(self):
+        import tempfile
+        with tempfile.NamedTemporaryFile('w', suffix='.fasta', delete=False) as f:
+            f.write('>sp|A|TEST1\nGARFIELDDEKARPERMEGAKIELLIEPK\n'
+                    '>sp|B|TEST2\nPEPTIDEKLATTERRSPAMR\nQELTICK\n')
+            self.fasta = f.name
+        self.espec = ExpMs2Spectrum('FIELDDEK', peptide_mass('FIELDDEK') + 0.3,
+                                    [(p + 0.01, 10.0) for p in Ionizer.default('FIELDDEK')])
+    
+    def tearDown(self):
+        import os
+        os.remove(self.fasta)
+
+
+class ProteinDB2Test(FastaTestCase):
+    def test_precompute(self):
+        from .scoring import SharedPeaks
+        plain = ProteinDB2(self.fasta)
+        precomputed = ProteinDB2(self.fasta, precompute=True)
+        self.assertEqual(len(precomputed.fragment_offsets), len(precomputed.peptides) + 1)
+        expected = plain.find_best_peptides(self.espec, SharedPeaks(0.1))
+        self.assertEqual(expected[0][0], 'TARGET FIELDDEK')
+        self.assertEqual(precomputed.find_best_peptides(self.espec, SharedPeaks(0.1)), expected)
+    
+    def test_fragment_index(self):
+        from .scoring import SharedPeaks
+        db = ProteinDB2(self.fasta, pep_tolerance=500)
+        expected = db.find_best_peptides(self.espec, SharedPeaks(0.1), amount=5)
+        db.build_fragment_index()
+        self.assertEqual(db.find_best_peptides(self.espec, SharedPeaks(0.1), amount=5), expected)
+        
+        # Isotopes and noise put several peaks within the tolerance of a fragment
+        peaks = [(p + d, 10.0) for p in Ionizer.default('FIELDDEK') for d in (-0.3, 0.01, 0.4, 1.0)]
+        crowded = ExpMs2Spectrum('crowded', self.espec.pepmass, peaks)
+        for scorer in (SharedPeaks(0.5), SharedPeaks(1.2)):
+            db.fragment_index = None
+            expected = db.find_best_peptides(crowded, scorer, amount=8)
+            db.build_fragment_index()
+            self.assertEqual(db.find_best_peptides(crowded, scorer, amount=8), expected)
+    
+    def test_mapped(self):
+        import os
+        from .scoring import Sequest
+        db = ProteinDB2(self.fasta, pep_tolerance=300)
+        fname = self.fasta + '.store'
+        try:
+            db.save(fname, mapped=True)
+            mapped = ProteinDB2.load(fname)
+            self.assertIsInstance(mapped, MappedProteinDB2)
+            self.assertEqual(mapped.pep_tolerance, 300)
+            self.assertEqual(list(mapped.peptides), list(db.peptides))
+            self.assertEqual([mapped.is_target(k) for k in range(len(db.peptides))],
+                             [db.is_target(k) for k in range(len(db.peptides))])
+            self.assertEqual(mapped.find_best_peptides(self.espec, Sequest(0.1)),
+                             db.find_best_peptides(self.espec, Sequest(0.1)))
+        finally:
+            os.remove(fname)
+    
+    def test_out_of_core(self):
+        import os
+        db = ProteinDB2(self.fasta, pep_tolerance=300)
+        fname = self.fasta + '.store'
+        try:
+            build_peptide_store(self.fasta, fname, pep_tolerance=300, run_size=5)
+            mapped = ProteinDB2.load(fname)
+            self.assertEqual(list(mapped.store_records()), list(db.store_records()))
+            del mapped
+            # Several merge passes
+            build_peptide_store(self.fasta, fname, pep_tolerance=300, run_size=2, fan_in=2)
+            self.assertEqual(list(ProteinDB2.load(fname).store_records()), list(db.store_records()))
+        finally:
+            os.remove(fname)
+    
+    def test_delta(self):
+        import os
+        import tempfile
+        from .scoring import Sequest
+        with tempfile.NamedTemporaryFile('w', suffix='.fasta', delete=False) as f:
+            f.write('>sp|C|ADDED\nFIELDDEKSPAMKWIK\n')
+        with open(self.fasta) as original, open(f.name) as added, \
+             tempfile.NamedTemporaryFile('w', suffix='.fasta', delete=False) as combined:
+            combined.write(original.read() + added.read())
+        fname = self.fasta + '.store'
+        
+        try:
+            rebuilt = ProteinDB2(combined.name, pep_tolerance=300)
+            db = ProteinDB2(self.fasta, pep_tolerance=300)
+            db.save(fname, mapped=True)
+            mapped = ProteinDB2.load(fname)
+            for d in (db, mapped):
+                d.add_fasta(f.name)
+                self.assertEqual(list(d.store_records()), list(rebuilt.store_records()))
+                self.assertEqual(d.find_best_peptides(self.espec, Sequest(0.1), amount=20),
+                                 rebuilt.find_best_peptides(self.espec, Sequest(0.1), amount=20))
+            
+            mapped.save()
+            mapped = ProteinDB2.load(fname)
+            self.assertEqual(list(mapped.store_records()), list(rebuilt.store_records()))
+            
+            # FIELDDEK is also in the database itself, it has to stay
+            original = list(ProteinDB2(self.fasta).store_records())
+            for d in (db, mapped):
+                d.add_fasta(f.name)
+                d.remove_fasta(f.name)
+                self.assertEqual(list(d.store_records()), list(rebuilt.store_records()))
+                d.remove_fasta(f.name)
+                d.compact()
+                self.assertIsNone(d.delta)
+                self.assertEqual(list(d.store_records()), original)
+                d.compact()
+            self.assertFalse(os.path.exists(fname + '.delta'))
+            self.assertNotIn('SPAMKWIK', set(db.peptides))
+        finally:
+            for name in (f.name, combined.name, fname, fname + '.delta'):
+                if os.path.exists(name):
+                    os.remove(name)
+    
+    def test_sweep(self):
+        from .scoring import Sequest
+        db = ProteinDB2(self.fasta, pep_tolerance=100)
+        spectra = [ExpMs2Spectrum(str(i), peptide_mass('FIELDDEK') + 40*(i%5) - 80, self.espec.peaks)
+                   for i in range(12)]
+        self.assertEqual(db.sweep_search(spectra, Sequest(0.1), amount=3),
+                         [(espec, db.find_best_peptides(espec, Sequest(0.1), amount=3)) for espec in spectra])
+    
+    def test_lazy(self):
+        import tempfile
+        from .scoring import Sequest
+        db = ProteinDB2(self.fasta, pep_tolerance=2)
+        lazy = LazyProteinDB2(self.fasta, pep_tolerance=2, segment_width=10.0)
+        spectra = [ExpMs2Spectrum(str(i), peptide_mass(pep), self.espec.peaks)
+                   for i, pep in enumerate(['FIELDDEK', 'GAR', 'KEDDLEIF', 'PEPTIDEK'])]
+        lazy.prepare(spectra[:2])
+        self.assertLess(len(lazy.peptides), len(db.peptides))
+        # Later segments are read from where the first pass found their peptides
+        self.assertIsNotNone(lazy.segment_spans)
+        for espec in spectra:
+            self.assertEqual(lazy.find_best_peptides(espec, Sequest(0.1), amount=3),
+                             db.find_best_peptides(espec, Sequest(0.1), amount=3))
+        self.assertEqual(lazy.sweep_search(spectra, Sequest(0.1), amount=3),
+                         db.sweep_search(spectra, Sequest(0.1), amount=3))
+        
+        with tempfile.TemporaryDirectory() as directory:
+            fname = os.path.join(directory, 'lazy.pickle')
+            lazy.save(fname)
+            loaded = LazyProteinDB2.load(fname)
+            self.assertEqual(list(loaded.peptides), list(lazy.peptides))
+            self.assertEqual(loaded.find_best_peptides(spectra[0], Sequest(0.1), amount=3),
+                             db.find_best_peptides(spectra[0], Sequest(0.1), amount=3))
+            db.save(fname)
+            self.assertRaises(ValueError, LazyProteinDB2.load, fname)
+            
+            lazy.save(fname)
+            with open(self.fasta, 'a') as f:
+                f.write('>sp|C|NEW\nFIELDDEKWIK\n')
+            self.assertRaises(ValueError, LazyProteinDB2.load, fname)
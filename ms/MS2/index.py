@@ -0,0 +1,62 @@
+"""Fragment-ion index for the MS2 database"""
+
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+from ms.util import *
+
+
+class FragmentIndex:
+    """Inverted index from fragment masses to peptides, built from the flat buffers of
+    `ProteinDB2.precompute_spectra`. Fragments are grouped in bins of width bin_width.
+    Within a bin, entries are sorted on peptide id (the index of the peptide in the mass
+    sorted peptide list), so the candidates of a precursor window form a contiguous range
+    in every bin. Querying walks the experimental peaks once, and doesn't have to look at
+    candidates that don't share a fragment with the spectrum.
+    """
+    
+    def __init__(self, fragments, offsets, bin_width=0.1):
+        self.bin_width = bin_width
+        num_bins = int(max(fragments, default=0.0) / bin_width) + 2
+        
+        # Counting sort on bin. Peptides are visited in order, so every bin is sorted on id.
+        bin_offsets = array('Q', bytes(8 * (num_bins+1)))
+        for m in fragments:
+            bin_offsets[int(m / bin_width) + 1] += 1
+        for b in range(num_bins):
+            bin_offsets[b+1] += bin_offsets[b]
+        
+        cursor = array('Q', bin_offsets)
+        self.peptide_ids = array('I', bytes(4 * len(fragments)))
+        self.masses = array('d', bytes(8 * len(fragments)))
+        for pid in progress_bar(range(len(offsets)-1), 'Building fragment index'):
+            for o in range(offsets[pid], offsets[pid+1]):
+                m = fragments[o]
+                b = int(m / bin_width)
+                pos = cursor[b]
+                self.peptide_ids[pos] = pid
+                self.masses[pos] = m
+                cursor[b] = pos + 1
+        
+        self.bin_offsets = bin_offsets
+    
+    def hits(self, espec, start, end, tolerance, weighted=False) -> '{pid: score}':
+        """Counts the (fragment, peak) pairs within tolerance for every peptide with an id
+        in [start, end). If weighted, the intensities of the peaks are summed instead."""
+        hits = defaultdict(float if weighted else int)
+        ids = self.peptide_ids
+        masses = self.masses
+        bin_offsets = self.bin_offsets
+        last_bin = len(bin_offsets) - 2
+        
+        for loc, intensity in zip(espec.locations, espec.intensities):
+            first = max(int((loc - tolerance) / self.bin_width), 0)
+            last = min(int((loc + tolerance) / self.bin_width), last_bin)
+            for b in range(first, last+1):
+                lo, hi = bin_offsets[b], bin_offsets[b+1]
+                for e in range(bisect_left(ids, start, lo, hi), bisect_left(ids, end, lo, hi)):
+                    if abs(masses[e] - loc) <= tolerance:
+                        hits[ids[e]] += intensity if weighted else 1
+        
+        return hits
@@ -0,0 +1,101 @@
+"""Writing search results (peptide-spectrum matches) as they come, in a machine-readable format"""
+
+import json
+import time
+
+from ms.util import *
+
+output_formats = ('tsv', 'jsonl')
+
+
+def output_format(fname):
+    """Guesses the format from the file name, TSV unless it looks like JSON"""
+    return 'jsonl' if fname.endswith(('.json', '.jsonl', '.ndjson')) else 'tsv'
+
+
+class PsmWriter:
+    """Streams the best peptides of every spectrum to a file, one line per
+    peptide-spectrum match, as TSV (with a header) or JSON lines. Nothing is
+    kept, and the file is flushed every flush_every spectra or seconds
+    (whichever comes first), so partial results survive an interrupted run."""
+    
+    columns = ('title', 'rank', 'peptide', 'type', 'score', 'delta')
+    
+    def __init__(self, f, format='tsv', flush_every=100, flush_seconds=5.0):
+        if format not in output_formats:
+            raise ValueError('Unknown output format {!r}, options are {}'.format(format, output_formats))
+        self.f = f
+        self.format = format
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+        
+        if format == 'tsv':
+            f.write('\t'.join(self.columns) + '\n')
+    
+    def psms(self, espec, scores) -> '[(title, rank, peptide, type, score, delta)]':
+        """Titles are 'TARGET <peptide>' or 'DECOY  <peptide>', as made by ProteinDB2.
+        The precursor delta is the spectrum's precursor mass minus the peptide mass."""
+        for rank, (name, score) in enumerate(scores, 1):
+            kind, peptide = name.split()
+            yield (espec.title, rank, peptide, kind.lower(), score, espec.pepmass - peptide_mass(peptide))
+    
+    def write(self, espec, scores):
+        if self.format == 'tsv':
+            for psm in self.psms(espec, scores):
+                self.f.write('\t'.join(str(v).replace('\t', ' ') for v in psm) + '\n')
+        else:
+            for psm in self.psms(espec, scores):
+                self.f.write(json.dumps(dict(zip(self.columns, psm))) + '\n')
+        
+        self.unflushed += 1
+        if self.unflushed >= self.flush_every or time.monotonic() - self.last_flush >= self.flush_seconds:
+            self.flush()
+    
+    def flush(self):
+        self.f.flush()
+        self.unflushed = 0
+        self.last_flush = time.monotonic()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.flush()
+
+
+
+# Tests
+
+from .db import FastaTestCase
+
+class PsmWriterTest(FastaTestCase):
+    def test_formats(self):
+        import io
+        from .db import ProteinDB2
+        from .scoring import SharedPeaks
+        db = ProteinDB2(self.fasta, pep_tolerance=300)
+        scores = db.find_best_peptides(self.espec, SharedPeaks(0.1), amount=3)
+        
+        f = io.StringIO()
+        with PsmWriter(f) as writer:
+            writer.write(self.espec, scores)
+        header, first, *rest = f.getvalue().splitlines()
+        self.assertEqual(header.split('\t'), list(PsmWriter.columns))
+        self.assertEqual(first.split('\t')[:4], ['FIELDDEK', '1', 'FIELDDEK', 'target'])
+        self.assertAlmostEqual(float(first.split('\t')[5]), 0.3)
+        self.assertEqual(len(rest), 2)
+        
+        f = io.StringIO()
+        with PsmWriter(f, 'jsonl') as writer:
+            writer.write(self.espec, scores)
+        psms = [json.loads(l) for l in f.getvalue().splitlines()]
+        self.assertEqual([psm['rank'] for psm in psms], [1, 2, 3])
+        self.assertEqual(psms[0]['peptide'], 'FIELDDEK')
+        self.assertEqual(psms[0]['score'], scores[0][1])
+    
+    def test_format(self):
+        self.assertEqual(output_format('psms.jsonl'), 'jsonl')
+        self.assertEqual(output_format('psms.tsv'), 'tsv')
+        self.assertRaises(ValueError, PsmWriter, None, 'csv')
@@ -0,0 +1,31 @@
+"""Searching many spectra at once, spread over multiple processes"""
+
+from ms.util import *
+
+
+def _search_one(shared, espec):
+    db, scorer, amount = shared
+    return db.find_best_peptides(espec, scorer, amount=amount)
+
+
+def search_spectra(db, spectra, scorer, amount=10, workers=1, backlog=None) -> '[(espec, [(name, score)])]':
+    """Yields the best peptides for every spectrum, in the same order as spectra.
+    With workers > 1, spectra are scored by a pool of processes sharing the database
+    (see `pool_map`). The results are identical to a serial search."""
+    return pool_map(_search_one, spectra, workers, (db, scorer, amount), backlog)
+
+
+
+# Tests
+
+from .db import FastaTestCase
+
+class SearchSpectraTest(FastaTestCase):
+    def test_workers(self):
+        from .db import ProteinDB2
+        from .scoring import Sequest
+        db = ProteinDB2(self.fasta, pep_tolerance=300)
+        spectra = [self.espec] * 5
+        serial = list(search_spectra(db, spectra, Sequest(0.1), amount=3))
+        parallel = list(search_spectra(db, spectra, Sequest(0.1), amount=3, workers=2))
+        self.assertEqual(parallel, serial)
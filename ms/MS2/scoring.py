@@ -2,39 +2,144 @@
 
 import heapq
 import math
-from itertools import chain
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import chain, islice, accumulate
 
 from .db import *
 from .spectra import *
 
 
+class PeakFilter:
+    """Selects the peaks of an experimental spectrum that are used for scoring. Fewer
+    peaks make every candidate cheaper to score, at the cost of some sensitivity.
+    Every option is off by default, the others are applied in this order:
+    
+      - precursor_tolerance: remove peaks within this distance of the precursor (pepmass)
+      - min_intensity: remove peaks below this fraction of the most intense peak
+      - window_top: keep only the window_top most intense peaks of every window of
+        window_width (e.g. 6 per 100 m/z, in the style of X!Tandem)
+      - top: keep only the top most intense peaks (Eng1994 keeps 200)
+    
+    Peaks are selected with heapq, without sorting all of them on intensity.
+    """
+    
+    def __init__(self, top=None, window_top=None, window_width=100.0,
+                 precursor_tolerance=None, min_intensity=None):
+        self.top = top
+        self.window_top = window_top
+        self.window_width = window_width
+        self.precursor_tolerance = precursor_tolerance
+        self.min_intensity = min_intensity
+    
+    def __call__(self, espec: ExpMs2Spectrum) -> ExpMs2Spectrum:
+        """The spectrum with the selected peaks only, or espec itself if they all are"""
+        locations, intensities = espec.locations, espec.intensities
+        keep = range(len(locations))
+        
+        if self.precursor_tolerance is not None:
+            low = bisect_left(locations, espec.pepmass - self.precursor_tolerance)
+            high = bisect_right(locations, espec.pepmass + self.precursor_tolerance)
+            keep = [i for i in keep if not low <= i < high]
+        
+        if self.min_intensity is not None and keep:
+            threshold = self.min_intensity * max(intensities)
+            keep = [i for i in keep if intensities[i] >= threshold]
+        
+        if self.window_top is not None:
+            windowed = []
+            first = 0
+            while first < len(keep):
+                window_end = locations[keep[first]] + self.window_width
+                last = first
+                while last < len(keep) and locations[keep[last]] < window_end:
+                    last += 1
+                window = keep[first:last]
+                if len(window) > self.window_top:
+                    window = sorted(heapq.nlargest(self.window_top, window, key=intensities.__getitem__))
+                windowed.extend(window)
+                first = last
+            keep = windowed
+        
+        if self.top is not None and len(keep) > self.top:
+            keep = sorted(heapq.nlargest(self.top, keep, key=intensities.__getitem__))
+        
+        if len(keep) == len(locations):
+            return espec
+        return type(espec).from_arrays(espec.title, espec.pepmass, array('d', (locations[i] for i in keep)),
+                                       array('d', (intensities[i] for i in keep)))
+    
+    def __repr__(self):
+        options = ('top', 'window_top', 'window_width', 'precursor_tolerance', 'min_intensity')
+        return 'PeakFilter({})'.format(', '.join('{}={!r}'.format(o, getattr(self, o)) for o in options
+                                                 if getattr(self, o) is not None))
+
+
 class Scorer:
-    def __init__(self, tolerance):
+    peak_filter = None
+    
+    def __init__(self, tolerance, peak_filter=None):
         self.tolerance = tolerance
+        self.peak_filter = peak_filter
     
     def score(self, tspec: TheoMs2Spectrum, espec: ExpMs2Spectrum):
         raise NotImplemented("score is not overriden")
     
-    # Define preproc_espec if there is a need for preprocessing
+    # Define preproc_espec if there is a need for preprocessing, starting with filter_peaks
     def preprocess_espec(self, espec: ExpMs2Spectrum):
-        return espec
+        return self.filter_peaks(espec)
+    
+    def filter_peaks(self, espec: ExpMs2Spectrum):
+        """The peaks of espec selected by peak_filter (see PeakFilter), if any"""
+        return espec if self.peak_filter is None else self.peak_filter(espec)
+    
+    # Scorers that can be bounded with a FragmentIndex can define
+    # index_bounds(index, espec, start, end) -> {peptide id: upper bound on score},
+    # peptides that aren't in it score 0
+    
+    # Scorers can define upper_bound(tspec, espec), a cheap upper bound on score(tspec, espec),
+    # so candidates that can't make it into the top results aren't scored (see `best_scores`)
+
+
+def within_tolerance(locations, values, loc, tolerance):
+    """Sum of the values (given as cumulative sums) of the locations within tolerance of loc"""
+    tolerance += bound_slack
+    return values[bisect_right(locations, loc + tolerance)] - values[bisect_left(locations, loc - tolerance)]
 
 
 class SharedPeaks(Scorer):
+    def preprocess_espec(self, espec):
+        espec = self.filter_peaks(espec)
+        new_espec = PreprocessedMs2Spectrum.from_arrays(espec.title, espec.pepmass,
+                                                        espec.locations, espec.intensities)
+        new_espec.ones = range(len(new_espec.locations) + 1)
+        return new_espec
+    
+    def upper_bound(self, tspec, espec):
+        """Every match counted by `score` is a different (fragment, peak) pair within
+        tolerance, so the amount of those pairs is an upper bound."""
+        return sum(within_tolerance(espec.locations, espec.ones, p, self.tolerance)
+                   for p in tspec.peaks)
+    
     def score(self, tspec: TheoMs2Spectrum, espec: ExpMs2Spectrum):
         i, j, score = 0, 0, 0
         tp = tspec.peaks
-        ep = espec.peaks
-        while i != len(tp) and j != len(ep):
-            if abs(tp[i] - ep[j][0]) <= self.tolerance:
+        ep = espec.locations
+        len_t, len_e = len(tp), len(ep)
+        while i != len_t and j != len_e:
+            if abs(tp[i] - ep[j]) <= self.tolerance:
                 score += 1
             
-            if (tp[i] < ep[j][0] and not i == len(tp)-1) or j == len(ep)-1:
+            if (tp[i] < ep[j] and not i == len_t-1) or j == len_e-1:
                 i += 1
             else:
                 j += 1
         
         return score
+    
+    def index_bounds(self, index, espec, start, end):
+        """The amount of (fragment, peak) pairs within tolerance, like upper_bound"""
+        return index.hits(espec, start, end, self.tolerance)
 
 
 class Sequest(Scorer):
@@ -51,25 +156,36 @@ class Sequest(Scorer):
         something like bins (but with more accuracy) of width tolerance/10.
     """
     
-    def __init__(self, tolerance, num_windows=10, stepsize=1.0, steps=75):
-        super().__init__(tolerance)
+    def __init__(self, tolerance, num_windows=10, stepsize=1.0, steps=75, peak_filter=None):
+        super().__init__(tolerance, peak_filter)
         self.num_windows = num_windows
         self.stepsize = stepsize
         self.steps = steps
     
     def preprocess_espec(self, espec, compress=True):
+        espec = self.filter_peaks(espec)
+        new_espec = PreprocessedMs2Spectrum.from_arrays(espec.title, espec.pepmass, espec.locations,
+                                                        self.normalize(espec.locations, espec.intensities))
+        # This is (very) specific to Eng2008
+        new_espec.y_prime_locations, new_espec.y_prime = self.y_prime(new_espec, compress)
+        # For upper_bound
+        new_espec.y_prime_positive = array('d', accumulate((max(v, 0.0) for v in new_espec.y_prime),
+                                                           initial=0.0))
+        return new_espec
+    
+    def normalize(self, locations, intensities) -> array:
+        """Returns the normalized intensities of the peaks, which are sorted on location"""
         # Preprocessing the peaks never seems to be fully described. The most important
         # thing to do (mentioned in both papers) is normalizing the intensities in a given
         # amount of fixed windows to 50 (or 100)
-        ep = espec.peaks
-        min_loc = min(ep, key=ExpMs2Spectrum.location)[0]
-        max_loc = max(ep, key=ExpMs2Spectrum.location)[0]
-        
-        # only retain the 200 most intense peaks (Only in Eng1994)
-        #ep = heapq.nlargest(200, ep, ExpMs2Spectrum.intensity)
+        # Eng1994 only retains the 200 most intense peaks, that's PeakFilter(top=200)
+        if not locations:
+            return array('d')
+        min_loc = locations[0]
+        max_loc = locations[-1]
         
         # extra sqrt (Only in Eng2008?)
-        ep = [(loc, math.sqrt(intensity)) for loc, intensity in ep]
+        ep = array('d', map(math.sqrt, intensities))
         
         # normalize in fixed amount of windows across the entire range (Eng1994 says 10)
         window_length = (max_loc - min_loc)/self.num_windows
@@ -78,8 +194,8 @@ class Sequest(Scorer):
         for window in range(self.num_windows):
             window_end = min_loc + window_length*(window+1)
             window_max = 0.0
-            while i < len(ep) and ep[i][0] <= window_end:
-                window_max = max(window_max, ep[i][1])
+            while i < len(ep) and locations[i] <= window_end:
+                window_max = max(window_max, ep[i])
                 i += 1
             window_maximums.append(window_max)
         
@@ -89,51 +205,186 @@ class Sequest(Scorer):
                 continue
             window_rescale = 50.0/window_maximums[window]
             window_end = min_loc + window_length*(window+1)
-            while i < len(ep) and ep[i][0] <= window_end:
-                ep[i] = (ep[i][0], ep[i][1] * window_rescale)
+            while i < len(ep) and locations[i] <= window_end:
+                ep[i] = ep[i] * window_rescale
                 i += 1
         
-        new_espec = ExpMs2Spectrum(espec.title, espec.pepmass, ep)
-        # This is (very) specific to Eng2008
-        new_espec.y_prime = self.y_prime(new_espec, compress)
-        return new_espec
+        return ep
     
-    def y_prime(self, espec, compress=True):
+    def y_prime(self, espec, compress=True) -> '(locations, values)':
         #  y' = y_0 - (sum(y_t for t in [-75..-1, 1..75])/150)
-        shifts = chain(frange(-self.steps * self.stepsize, 0, self.stepsize),
-                       frange(self.stepsize, (self.steps+1) * self.stepsize, self.stepsize))
-        resized_int = [-p[1]/(2*self.steps) for p in espec.peaks]
-        shifted = sum(([(espec.peaks[i][0]+t, resized_int[i]) for i in range(len(espec.peaks))]
-                            for t in shifts), [])
+        shifts = list(chain(frange(-self.steps * self.stepsize, 0, self.stepsize),
+                            frange(self.stepsize, (self.steps+1) * self.stepsize, self.stepsize)))
+        resized_int = array('d', (-v/(2*self.steps) for v in espec.intensities))
+        shifted_locs = array('d', (loc+t for t in shifts for loc in espec.locations))
+        shifted_vals = resized_int * len(shifts)
         
-        if compress:
+        if compress and shifted_locs:
             # Shifted produces way too many points. While mathematically still correct (since
             # our dot_product is just a big sum anyway), it takes too much time. So, time for
             # a minimum amount of 'binning'
-            shifted = sorted(shifted, key=ExpMs2Spectrum.location)
-            locs = [shifted[0][0]]
-            total = shifted[0][1]
+            order = sorted(range(len(shifted_locs)), key=shifted_locs.__getitem__)
+            locs = [shifted_locs[order[0]]]
+            total = shifted_vals[order[0]]
             tol = self.tolerance / 10
-            binned = []
-            shifted_it = iter(shifted)
-            next(shifted_it)  # skip first without making a whole new list
-            for s in shifted_it:
-                if s[0] > locs[0] + tol:
-                    binned.append((sum(locs)/len(locs), total))
-                    locs = [s[0]]
-                    total = s[1]
+            binned_locs, binned_vals = array('d'), array('d')
+            for k in islice(order, 1, None):
+                loc = shifted_locs[k]
+                if loc > locs[0] + tol:
+                    binned_locs.append(sum(locs)/len(locs))
+                    binned_vals.append(total)
+                    locs = [loc]
+                    total = shifted_vals[k]
                 else:
-                    locs.append(s[0])
-                    total += s[1]
+                    locs.append(loc)
+                    total += shifted_vals[k]
             
-            return sorted(espec.peaks + binned, key=ExpMs2Spectrum.location)
+            return sort_peaks(espec.locations + binned_locs, espec.intensities + binned_vals)
         else:
-            return sorted(espec.peaks + shifted, key=ExpMs2Spectrum.location)
+            return sort_peaks(espec.locations + shifted_locs, espec.intensities + shifted_vals)
         
     def score(self, tspec, espec):
         """This is basically the xcorr score. An alternative would be the 
         E-value, as suggested by Eng2008. It's based on the xcorr yet vastly
         more complex.
         """
-        return dot_product(tspec.peaks, 50.0, espec.y_prime, self.tolerance)
+        return dot_product(tspec.peaks, 50.0, espec.y_prime_locations, espec.y_prime, self.tolerance)
+    
+    def upper_bound(self, tspec, espec):
+        """Every term of the dot product matches a fragment with a peak of y' within
+        tolerance, so the sum of all positive y' within tolerance is an upper bound."""
+        return 50.0 * sum(within_tolerance(espec.y_prime_locations, espec.y_prime_positive, p, self.tolerance)
+                          for p in tspec.peaks)
+
+
+class BinnedSequest(Sequest):
+    """Fast xcorr, in the style of Comet (Eng2013). Instead of shifting every peak
+    around, the preprocessed spectrum becomes one dense vector of bins (of width
+    tolerance), and the background (the mean of the surrounding 2*steps bins) is
+    subtracted once per spectrum using a cumulative sum. Scoring a candidate is then
+    just a lookup of the bins of its fragments.
+    
+    Like Comet, a bin_offset shifts the bin boundaries so that they don't fall right
+    where most peptide fragments are (around the integer masses).
+    """
+    
+    # Scoring is already a lookup per fragment, a bound wouldn't be any cheaper
+    upper_bound = None
+    
+    def __init__(self, tolerance=1.0005079, num_windows=10, steps=75, bin_offset=0.4, peak_filter=None):
+        super().__init__(tolerance, num_windows, steps=steps, peak_filter=peak_filter)
+        self.bin_offset = bin_offset
+    
+    def bin(self, loc):
+        return int(loc/self.tolerance + self.bin_offset)
+    
+    def preprocess_espec(self, espec):
+        espec = self.filter_peaks(espec)
+        new_espec = PreprocessedMs2Spectrum.from_arrays(espec.title, espec.pepmass, espec.locations,
+                                                        self.normalize(espec.locations, espec.intensities))
+        new_espec.xcorr_vector = self.xcorr_vector(new_espec)
+        return new_espec
+    
+    def xcorr_vector(self, espec):
+        # Bins after the last peak still get some background subtracted
+        size = (self.bin(espec.locations[-1]) if espec.locations else 0) + self.steps + 1
+        y = array('d', bytes(8*size))
+        for loc, intensity in zip(espec.locations, espec.intensities):
+            b = self.bin(loc)
+            y[b] = max(y[b], intensity)
+        
+        cumulative = array('d', bytes(8*(size+1)))
+        total = 0.0
+        for i in range(size):
+            total += y[i]
+            cumulative[i+1] = total
+        
+        #  y' = y_0 - (sum(y_t for t in [-75..-1, 1..75])/150)
+        steps = self.steps
+        y_prime = array('d', bytes(8*size))
+        for i in range(size):
+            background = cumulative[min(i+steps+1, size)] - cumulative[max(i-steps, 0)] - y[i]
+            y_prime[i] = y[i] - background/(2*steps)
+        return y_prime
+    
+    def score(self, tspec, espec):
+        y_prime = espec.xcorr_vector
+        size = len(y_prime)
+        total = 0.0
+        for p in tspec.peaks:
+            b = self.bin(p)
+            if b < size:
+                total += y_prime[b]
+        return 50.0 * total
+
+
+
+# Tests
+
+import unittest
+
+class BinnedSequestTest(unittest.TestCase):
+    def test_background(self):
+        scorer = BinnedSequest(1.0, steps=2, bin_offset=0.0)
+        espec = ExpMs2Spectrum('test', 500.0, [(1.5, 4.0), (3.2, 8.0), (4.1, 4.0)])
+        y_prime = scorer.xcorr_vector(espec)
+        y = [0.0, 4.0, 0.0, 8.0, 4.0, 0.0, 0.0]
+        self.assertEqual(len(y_prime), len(y))
+        for i in range(len(y)):
+            background = sum(y[i+t] for t in (-2, -1, 1, 2) if 0 <= i+t < len(y))
+            self.assertAlmostEqual(y_prime[i], y[i] - background/4)
+    
+    def test_planted_peptide(self):
+        from .db import Ionizer
+        scorer = BinnedSequest()
+        peaks = [(p, 100.0) for p in Ionizer.default('FIELDDEK')] + [(150.0, 80.0), (700.0, 60.0)]
+        espec = scorer.preprocess_espec(ExpMs2Spectrum('FIELDDEK', peptide_mass('FIELDDEK'), peaks))
+        scores = {s: scorer.score(TheoMs2Spectrum.from_sequence(s), espec)
+                  for s in ('FIELDDEK', 'KEDDLEIF', 'EIFLDDEK')}
+        self.assertEqual(max(scores, key=scores.get), 'FIELDDEK')
+
+
+class UpperBoundTest(unittest.TestCase):
+    def test_bounds(self):
+        from .db import Ionizer
+        peaks = [(p + 0.02, 100.0) for p in Ionizer.default('FIELDDEK')[::2]] + [(250.0, 80.0), (700.0, 60.0)]
+        espec = ExpMs2Spectrum('FIELDDEK', peptide_mass('FIELDDEK'), peaks)
+        tspecs = [TheoMs2Spectrum.from_sequence(s) for s in ('FIELDDEK', 'KEDDLEIF', 'EIFLDDEK', 'GARPER',
+                                                             'DEKFIELD', 'FIELDDEKAR', 'LEIFDDEK')]
+        for scorer in (SharedPeaks(0.1), Sequest(0.1)):
+            pp = scorer.preprocess_espec(espec)
+            for tspec in tspecs:
+                self.assertLessEqual(scorer.score(tspec, pp), scorer.upper_bound(tspec, pp))
+            for amount in range(1, 5):
+                self.assertEqual(best_scores(tspecs, pp, scorer, amount),
+                                 heapq.nlargest(amount, ((t.title, scorer.score(t, pp)) for t in tspecs),
+                                                key=lambda t: t[1]))
+
 
+class PeakFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.espec = ExpMs2Spectrum('test', 500.0, [(100.0, 5.0), (150.0, 1.0), (180.0, 9.0), (250.0, 2.0),
+                                                    (260.0, 7.0), (499.9, 100.0), (600.0, 3.0)])
+    
+    def locations(self, peak_filter):
+        return list(peak_filter(self.espec).locations)
+    
+    def test_options(self):
+        self.assertIs(PeakFilter()(self.espec), self.espec)
+        self.assertEqual(self.locations(PeakFilter(top=3)), [180.0, 260.0, 499.9])
+        self.assertEqual(self.locations(PeakFilter(window_top=1, window_width=100.0)),
+                         [180.0, 260.0, 499.9, 600.0])
+        self.assertEqual(self.locations(PeakFilter(precursor_tolerance=0.5, top=3)), [100.0, 180.0, 260.0])
+        self.assertEqual(self.locations(PeakFilter(min_intensity=0.05)), [100.0, 180.0, 260.0, 499.9])
+    
+    def test_scorers(self):
+        from .db import Ionizer
+        peaks = [(p, 100.0) for p in Ionizer.default('FIELDDEK')] + [(150.0 + i, 1.0) for i in range(50)]
+        espec = ExpMs2Spectrum('FIELDDEK', peptide_mass('FIELDDEK'), peaks)
+        tspec = TheoMs2Spectrum.from_sequence('FIELDDEK')
+        for scorer in (SharedPeaks(0.1, PeakFilter(top=14)), Sequest(0.1, peak_filter=PeakFilter(top=14)),
+                       BinnedSequest(peak_filter=PeakFilter(top=14))):
+            pp = scorer.preprocess_espec(espec)
+            self.assertEqual(len(pp.locations), 14)
+            scorer.score(tspec, pp)
+        self.assertEqual(len(Sequest(0.1, peak_filter=PeakFilter(min_intensity=2.0)).preprocess_espec(espec).y_prime), 0)
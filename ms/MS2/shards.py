@@ -0,0 +1,282 @@
+"""Searching a database that is split on peptide mass into shards, each one served
+by its own process, possibly on another host.
+
+A manifest (JSON) lists the shards: a peptide store (see ms.MS2.store), the range
+of peptide masses in it, and optionally the address of a server that has it open.
+Shards without an address are served by local processes. Usage::
+
+    python -m ms.MS2.shards split [-d FASTA | -p DB] -n <amount> <manifest>
+    python -m ms.MS2.shards serve <shard> --authkey KEY [--host HOST] [--port PORT]
+    python -m ms.MS2 --shards <manifest> [--shard-authkey KEY] <MGF file>
+
+Servers unpickle what they receive, so anyone with the authkey can run code on
+them: pick a secret key, and don't expose servers beyond the hosts that need them.
+"""
+
+import os
+import json
+import heapq
+from itertools import islice
+from multiprocessing.connection import Listener, Client
+
+from ms.util import *
+from .store import write_peptide_store
+from .db import ProteinDB2
+
+
+class Shard:
+    """A peptide store with peptide masses from low up to (and including) high"""
+    
+    def __init__(self, fname, low, high, address=None):
+        self.fname = fname
+        self.low = low
+        self.high = high
+        self.address = tuple(address) if address is not None else None
+    
+    def overlaps(self, low, high):
+        return self.low <= high and low <= self.high
+    
+    def as_dict(self):
+        return {'file': self.fname, 'low': self.low, 'high': self.high, 'address': self.address}
+
+
+def split_database(db, manifest, amount) -> '[Shard]':
+    """Writes the peptides of db to amount stores with (about) as many peptides each,
+    named after the manifest, and writes the manifest."""
+    size = -(-len(db.peptides) // amount)
+    records = iter(db.store_records())
+    shards = []
+    for i in range(amount):
+        fname = '{}.{}'.format(manifest, i)
+        masses = [None, None]
+        def tracked(records):
+            for record in records:
+                masses[masses[0] is not None] = record[0]
+                yield record
+        
+        # The last one takes everything that's left, including peptides added to db
+        with progress('Writing shard {}'.format(fname)):
+            write_peptide_store(fname, tracked(islice(records, size if i < amount - 1 else None)),
+                                db.pep_tolerance)
+        if masses[0] is None:
+            os.remove(fname)
+            break
+        shards.append(Shard(fname, masses[0], masses[1] if masses[1] is not None else masses[0]))
+    
+    write_manifest(manifest, shards, db.pep_tolerance)
+    return shards
+
+
+def write_manifest(manifest, shards, pep_tolerance):
+    # Shard files are relative to the manifest, so they can be moved together
+    directory = os.path.dirname(os.path.abspath(manifest))
+    data = {'pep_tolerance': pep_tolerance,
+            'shards': [dict(shard.as_dict(), file=os.path.relpath(os.path.abspath(shard.fname), directory))
+                       for shard in shards]}
+    with open(manifest, 'w') as f:
+        json.dump(data, f, indent=1)
+
+
+def read_manifest(manifest) -> '(shards, pep_tolerance)':
+    directory = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest) as f:
+        data = json.load(f)
+    shards = [Shard(os.path.join(directory, s['file']), s['low'], s['high'], s.get('address'))
+              for s in data['shards']]
+    return shards, data['pep_tolerance']
+
+
+def serve_shard(fname, address, authkey, ready=None):
+    """Serves searches in the store fname, for one coordinator at a time. Requests
+    are (spectra, scorer, amount, pep_tolerance), the answer is the best peptides
+    of every spectrum (or the exception raised). Stops when it gets None. The
+    address is sent to ready (a Connection), if given."""
+    db = ProteinDB2.load(fname)
+    with Listener(address, authkey=authkey) as listener:
+        if ready is not None:
+            ready.send(listener.address)
+            ready.close()
+        while True:
+            with listener.accept() as conn:
+                while True:
+                    try:
+                        request = conn.recv()
+                    except EOFError:
+                        break
+                    if request is None:
+                        return
+                    
+                    spectra, scorer, amount, db.pep_tolerance = request
+                    try:
+                        conn.send([db.find_best_peptides(espec, scorer, amount) for espec in spectra])
+                    except Exception as e:
+                        conn.send(e)
+
+
+def start_local_server(fname) -> '(process, address, authkey)':
+    """Serves a shard from a new process, with a fresh random authkey"""
+    import multiprocessing
+    authkey = os.urandom(32)
+    ctx = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+    ready, child_ready = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=serve_shard, args=(fname, ('localhost', 0), authkey, child_ready), daemon=True)
+    process.start()
+    child_ready.close()
+    return process, ready.recv(), authkey
+
+
+class ShardedProteinDB2:
+    """Searches shards like a ProteinDB2 would, with the same results. Every spectrum
+    only goes to the shards its precursor window overlaps, and their best peptides
+    are merged. Shards without an address get a local server process, shards with
+    one are reached with authkey."""
+    
+    def __init__(self, shards, pep_tolerance=1.2, authkey=None):
+        self.shards = shards
+        self.pep_tolerance = pep_tolerance
+        self.processes = []
+        self.connections = []
+        try:
+            for shard in shards:
+                if shard.address is None:
+                    process, address, key = start_local_server(shard.fname)
+                    self.processes.append(process)
+                    self.connections.append(Client(address, authkey=key))
+                elif authkey is None:
+                    raise ValueError('Shard {} is served on {}, that needs an authkey'.format(shard.fname,
+                                                                                          shard.address))
+                else:
+                    self.connections.append(Client(shard.address, authkey=authkey))
+        except BaseException:
+            self.close()
+            raise
+    
+    @classmethod
+    def load(cls, manifest, authkey=None):
+        shards, pep_tolerance = read_manifest(manifest)
+        return cls(shards, pep_tolerance, authkey)
+    
+    def search(self, spectra, scorer, amount=10, batch=64) -> '[(espec, [(name, score)])]':
+        """Yields the best peptides for every spectrum, in order. Spectra are sent in
+        batches, and all shards work on a batch at the same time."""
+        spectra = iter(spectra)
+        while True:
+            especs = list(islice(spectra, batch))
+            if not especs:
+                return
+            
+            routed = [[] for shard in self.shards]
+            for i, espec in enumerate(especs):
+                low, high = espec.pepmass - self.pep_tolerance, espec.pepmass + self.pep_tolerance
+                for indices, shard in zip(routed, self.shards):
+                    if shard.overlaps(low, high):
+                        indices.append(i)
+            
+            for indices, conn in zip(routed, self.connections):
+                if indices:
+                    conn.send(([especs[i] for i in indices], scorer, amount, self.pep_tolerance))
+            
+            # Shards are in mass order, so ties are broken like in a single database.
+            # Every answer is read, even after an error, so the connections stay usable.
+            merged = [[] for espec in especs]
+            error = None
+            for indices, conn in zip(routed, self.connections):
+                if indices:
+                    answer = conn.recv()
+                    if isinstance(answer, Exception):
+                        error = answer
+                        continue
+                    for i, scores in zip(indices, answer):
+                        merged[i].extend(scores)
+            if error is not None:
+                raise error
+            
+            for espec, scores in zip(especs, merged):
+                yield espec, heapq.nlargest(amount, scores, key=lambda t: t[1])
+    
+    def find_best_peptides(self, espec, scorer, amount=10):
+        (espec, scores), = self.search([espec], scorer, amount)
+        return scores
+    
+    def close(self):
+        """Disconnects, and stops the local servers"""
+        for conn, shard in zip(self.connections, self.shards):
+            if shard.address is None:
+                conn.send(None)
+            conn.close()
+        for process in self.processes:
+            process.join()
+        self.connections, self.processes = [], []
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Sharded MS2 database search')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    
+    split = commands.add_parser('split', help='Split a database into shards on peptide mass')
+    split.add_argument('-d', '--database', help='FASTA file to use for the database',
+                                           default=ProteinDB2.default_file)
+    split.add_argument('-p', '--pickled', help='Database (pickle or store) to split, instead of a FASTA file',
+                                          default=None)
+    split.add_argument('-n', '--amount', help='Amount of shards', type=int, default=2)
+    split.add_argument('-t', '--pep-tolerance', help='Tolerance on the precursor mass', type=float, default=None)
+    split.add_argument('manifest', help='Manifest to write, shards are written next to it')
+    
+    serve = commands.add_parser('serve', help='Serve a shard to coordinators on other hosts')
+    serve.add_argument('shard', help='Shard (peptide store) to serve')
+    serve.add_argument('--host', help='Address to listen on', default='localhost')
+    serve.add_argument('--port', help='Port to listen on', type=int, default=6000)
+    serve.add_argument('--authkey', help='Shared secret of servers and coordinator. Anyone who has it can run '
+                                         'code on the server.',
+                                    required=True)
+    args = parser.parse_args()
+    
+    if args.command == 'split':
+        db = ProteinDB2.load(args.pickled) if args.pickled else ProteinDB2(args.database)
+        if args.pep_tolerance is not None:
+            db.pep_tolerance = args.pep_tolerance
+        for shard in split_database(db, args.manifest, args.amount):
+            print('{}  {:.4f} - {:.4f}'.format(shard.fname, shard.low, shard.high))
+    else:
+        print('Serving {} on {}:{}'.format(args.shard, args.host, args.port))
+        serve_shard(args.shard, (args.host, args.port), args.authkey.encode())
+
+
+
+# Tests
+
+from .db import FastaTestCase
+
+class ShardsTest(FastaTestCase):
+    def test_sharded(self):
+        import tempfile
+        from .spectra import ExpMs2Spectrum
+        from .scoring import Sequest, SharedPeaks
+        db = ProteinDB2(self.fasta, pep_tolerance=300)
+        with tempfile.TemporaryDirectory() as directory:
+            manifest = os.path.join(directory, 'db.shards')
+            shards = split_database(db, manifest, 3)
+            self.assertEqual(len(shards), 3)
+            self.assertLessEqual(shards[0].high, shards[1].low)
+            
+            spectra = [self.espec, ExpMs2Spectrum('light', 500.0, self.espec.peaks)]
+            with ShardedProteinDB2.load(manifest) as sharded:
+                self.assertEqual(sharded.pep_tolerance, 300)
+                for scorer in (Sequest(0.1), SharedPeaks(0.1)):
+                    expected = [(espec, db.find_best_peptides(espec, scorer, 5)) for espec in spectra]
+                    self.assertEqual(list(sharded.search(spectra, scorer, 5, batch=1)), expected)
+                    self.assertEqual(list(sharded.search(spectra, scorer, 5)), expected)
+                sharded.pep_tolerance = 1.2
+                self.assertEqual(sharded.find_best_peptides(spectra[1], Sequest(0.1)), [])
+            
+            shards[0].address = ('localhost', 1)
+            self.assertRaises(ValueError, ShardedProteinDB2, shards)
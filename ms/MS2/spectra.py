@@ -1,13 +1,23 @@
 """MS2 spectra, theoretical ionization and database"""
 
 import heapq
+from array import array
 from itertools import repeat, chain
 
 from ms.util import *
 from ms.MS1 import ProteinDB, shared_peak
 
 
+def sort_peaks(locations, values) -> '(locations, values)':
+    """Sorts peaks given as two sequences on location, into two new arrays. Like
+    sorted, peaks with the same location keep their order."""
+    order = sorted(range(len(locations)), key=locations.__getitem__)
+    return array('d', (locations[i] for i in order)), array('d', (values[i] for i in order))
+
+
 class Ms2Spectrum:
+    __slots__ = ('title', 'pepmass')
+    
     def __init__(self, title, pepmass):
         self.title = title
         self.pepmass = float(pepmass)
@@ -15,9 +25,11 @@ class Ms2Spectrum:
 
 class TheoMs2Spectrum(Ms2Spectrum):
     """Theoretical MS2 Spectrum.
-    Here, self.peaks is just a list of peak locations.
+    Here, self.peaks is just an array (or memoryview) of peak locations.
     """
     
+    __slots__ = ('peaks',)
+    
     @classmethod
     def from_sequence(cls, s, ionizer=None):
         """Not used in the analysis, useful for visualisation and comparison."""
@@ -28,9 +40,9 @@ class TheoMs2Spectrum(Ms2Spectrum):
                    pepmass=peptide_mass(s),
                    peaks=ionizer(s))
     
-    def __init__(self, title, pepmass, peaks):
+    def __init__(self, title, pepmass, peaks, presorted=False):
         super().__init__(title, pepmass)
-        self.peaks = sorted(peaks)
+        self.peaks = peaks if presorted else array('d', sorted(peaks))
     
     def plot(self, color='red'):
         import matplotlib.pyplot as plt
@@ -39,30 +51,57 @@ class TheoMs2Spectrum(Ms2Spectrum):
 
 class ExpMs2Spectrum(Ms2Spectrum):
     """Experimental MS2 Spectrum.
-    Here, self.peaks is a list of (location, intensity) tuples.
+    Here, the peaks are two arrays, locations and intensities, sorted on location.
+    self.peaks gives them as a list of (location, intensity) tuples.
     """
     
+    __slots__ = ('locations', 'intensities')
+    
     location = lambda t: t[0]
-    intensity = lambda t: [1]
+    intensity = lambda t: t[1]
     
     def __init__(self, title, pepmass, peaks, **kwargs):
         super().__init__(title, pepmass)
-        self.peaks = sorted(peaks, key=lambda t: t[0])
+        peaks = sorted(peaks, key=lambda t: t[0])
+        self.locations = array('d', (p[0] for p in peaks))
+        self.intensities = array('d', (p[1] for p in peaks))
+    
+    @classmethod
+    def from_arrays(cls, title, pepmass, locations, intensities, **kwargs):
+        """Like the constructor, without going through tuples. The arrays are used as
+        they are (not copied) if they're sorted on location already."""
+        espec = cls.__new__(cls)
+        Ms2Spectrum.__init__(espec, title, pepmass)
+        if any(locations[i] > locations[i+1] for i in range(len(locations) - 1)):
+            locations, intensities = sort_peaks(locations, intensities)
+        espec.locations = locations
+        espec.intensities = intensities
+        return espec
+    
+    @property
+    def peaks(self) -> '[(location, intensity)]':
+        return list(zip(self.locations, self.intensities))
     
     def plot(self, color='blue'):
         import matplotlib.pyplot as plt
-        plt.stem([p[0] for p in self.peaks], [p[1] for p in self.peaks], color, label=self.title)
+        plt.stem(self.locations, self.intensities, color, label=self.title)
     
     @classmethod
     @simple_progress('Loading MS2 spectra')
     def load_spectra(cls, fname, maximum=float('inf')) -> '[ExpMs2Spectrum]':
         """Parse a MGF file"""
-        spectra = []
+        return list(cls.iter_spectra(fname, maximum))
+    
+    @classmethod
+    def iter_spectra(cls, fname, maximum=float('inf')) -> '[ExpMs2Spectrum]':
+        """Parse a MGF file lazily, one spectrum at a time"""
+        count = 0
         with open(fname) as f:
             lines = nice_lines(f)
             for line in lines:
                 if line == 'BEGIN IONS':
-                    peaks = []
+                    locations = array('d')
+                    intensities = array('d')
                     metadata = {}
                     
                     for peak in lines:
@@ -73,13 +112,14 @@ class ExpMs2Spectrum(Ms2Spectrum):
                             metadata[kv[0]] = kv[1]
                         else:
                             location, intensity = peak.split()
-                            peaks.append((float(location.strip()), float(intensity.strip())))
+                            locations.append(float(location))
+                            intensities.append(float(intensity))
                     
-                    spectra.append(cls(metadata.pop('TITLE'), metadata.pop('PEPMASS').split(' ')[0],
-                                       peaks, **metadata))
-                    if len(spectra) >= maximum:
+                    yield cls.from_arrays(metadata.pop('TITLE'), metadata.pop('PEPMASS').split(' ')[0],
+                                          locations, intensities, **metadata)
+                    count += 1
+                    if count >= maximum:
                         break
-        return spectra
 
     @staticmethod
     def _key_value(line):
@@ -87,3 +127,46 @@ class ExpMs2Spectrum(Ms2Spectrum):
         if len(parts) < 2:
             return None
         return parts[0].strip().upper(), parts[1].strip()
+
+
+class PreprocessedMs2Spectrum(ExpMs2Spectrum):
+    """Experimental MS2 Spectrum, as returned by `Scorer.preprocess_espec`.
+    Unlike plain spectra, scorers can add their own attributes to these."""
+
+
+
+# Tests
+
+import unittest
+
+class LoadSpectraTest(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        with tempfile.NamedTemporaryFile('w', suffix='.mgf', delete=False) as f:
+            for i in range(3):
+                f.write('BEGIN IONS\nTITLE=spectrum {}\nPEPMASS=500.0 1234.5\nCHARGE=2+\n'
+                        '300.5 10.0\n200.25 20.0\n\nEND IONS\n\n'.format(i))
+            self.mgf = f.name
+    
+    def tearDown(self):
+        import os
+        os.remove(self.mgf)
+    
+    def test_iter_spectra(self):
+        spectra = ExpMs2Spectrum.iter_spectra(self.mgf)
+        first = next(spectra)
+        self.assertEqual(first.title, 'spectrum 0')
+        self.assertEqual(first.pepmass, 500.0)
+        self.assertEqual(first.peaks, [(200.25, 20.0), (300.5, 10.0)])
+        self.assertEqual(len(list(spectra)), 2)
+    
+    def test_arrays(self):
+        espec = ExpMs2Spectrum('test', 500.0, [(300.5, 10.0), (200.25, 20.0)])
+        self.assertEqual(espec.locations, array('d', [200.25, 300.5]))
+        self.assertEqual(espec.intensities, array('d', [20.0, 10.0]))
+        self.assertFalse(hasattr(espec, '__dict__'))
+        unsorted = ExpMs2Spectrum.from_arrays('test', 500.0, array('d', [300.5, 200.25]), array('d', [10.0, 20.0]))
+        self.assertEqual(unsorted.peaks, espec.peaks)
+    
+    def test_maximum(self):
+        self.assertEqual(len(ExpMs2Spectrum.load_spectra(self.mgf, maximum=2)), 2)
@@ -0,0 +1,284 @@
+"""A versioned, memory-mapped binary format for the peptides of a ProteinDB2.
+
+Layout (native byte order, which is recorded and checked)::
+
+    header       see HEADER, padded to HEADER_SIZE bytes
+    masses       float64 * count, sorted
+    offsets      uint64 * (count+1), peptide k is residues[offsets[k]:offsets[k+1]]
+    flags        uint8 * count, TARGET and/or DECOY
+    residues     ASCII, all peptides concatenated
+
+Every section starts at a multiple of 8 bytes. Opening a store only maps the file,
+so it's near-instant and the pages are shared between processes.
+"""
+
+import os
+import sys
+import mmap
+import shutil
+import struct
+import heapq
+import tempfile
+from array import array
+from bisect import bisect_left, bisect_right
+
+from ms.util import *
+
+
+MAGIC = b'MSPEPDB\0'
+VERSION = 1
+# magic, version, little endian?, count, offsets of masses/offsets/flags/residues,
+# length of residues, pep_tolerance
+HEADER = struct.Struct('<8sII6Qd')
+HEADER_SIZE = 128
+
+TARGET = 1
+DECOY = 2
+
+# Amount of peptides buffered in memory while writing
+write_batch = 1 << 16
+
+
+def is_peptide_store(fname):
+    try:
+        with open(fname, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def _align(f):
+    f.write(bytes(-f.tell() % 8))
+
+
+def write_peptide_store(fname, records, pep_tolerance=1.2):
+    """Writes (mass, peptide, flags) records, sorted on mass, to a store. Records are
+    streamed, so they don't need to fit in memory. The file is replaced atomically,
+    so it's safe to overwrite a store that's currently mapped."""
+    
+    tmp_name = fname + '.tmp'
+    with open(tmp_name, 'w+b') as f, tempfile.TemporaryFile() as offsets_f, \
+         tempfile.TemporaryFile() as flags_f, tempfile.TemporaryFile() as residues_f:
+        f.write(bytes(HEADER_SIZE))
+        count = 0
+        total = 0
+        last_mass = float('-inf')
+        offsets_f.write(array('Q', [0]).tobytes())
+        
+        masses, offsets, flags, residues = array('d'), array('Q'), bytearray(), []
+        def flush():
+            f.write(masses.tobytes())
+            offsets_f.write(offsets.tobytes())
+            flags_f.write(flags)
+            residues_f.write(b''.join(residues))
+            del masses[:], offsets[:], flags[:], residues[:]
+        
+        for mass, pep, flag in records:
+            if mass < last_mass:
+                raise ValueError('Peptides should be sorted on mass')
+            last_mass = mass
+            pep = pep.encode('ascii')
+            total += len(pep)
+            masses.append(mass)
+            offsets.append(total)
+            flags.append(flag)
+            residues.append(pep)
+            count += 1
+            if len(masses) >= write_batch:
+                flush()
+        flush()
+        
+        sections = []
+        for section in (offsets_f, flags_f, residues_f):
+            _align(f)
+            sections.append(f.tell())
+            section.seek(0)
+            shutil.copyfileobj(section, f)
+        
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, sys.byteorder == 'little', count, HEADER_SIZE,
+                            *sections, total, pep_tolerance))
+    os.replace(tmp_name, fname)
+
+
+class MappedPeptides:
+    """Read-only, memory-mapped peptide list. Behaves like the SortedCollection
+    of peptides (keyed on mass) in ProteinDB2."""
+    
+    def __init__(self, fname):
+        self.fname = os.path.abspath(fname)
+        with open(fname, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        (magic, version, little, count, masses_at, offsets_at, flags_at, residues_at,
+         residues_len, self.pep_tolerance) = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError('{} is not a peptide store'.format(fname))
+        if version != VERSION:
+            raise ValueError('{} has version {}, expected {}'.format(fname, version, VERSION))
+        if bool(little) != (sys.byteorder == 'little'):
+            raise ValueError('{} was written on a machine with another byte order'.format(fname))
+        
+        view = memoryview(self._mmap)
+        self._keys = view[masses_at : masses_at + 8*count].cast('d')
+        self._offsets = view[offsets_at : offsets_at + 8*(count+1)].cast('Q')
+        self._flags = view[flags_at : flags_at + count]
+        self._residues = view[residues_at : residues_at + residues_len]
+    
+    def __reduce__(self):
+        # Other processes just map the file again
+        return self.__class__, (self.fname,)
+    
+    def __len__(self):
+        return len(self._keys)
+    
+    def __getitem__(self, k):
+        return str(self._residues[self._offsets[k]:self._offsets[k+1]], 'ascii')
+    
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+    
+    def flags(self, k):
+        return self._flags[k]
+    
+    def flags_of(self, pep):
+        """Flags of a peptide, or 0 if it isn't in the store"""
+        mass = peptide_mass(pep)
+        i, j = self.index_between(mass, mass)
+        for k in range(i, j):
+            if self[k] == pep:
+                return self._flags[k]
+        return 0
+    
+    def is_target(self, k):
+        return bool(self._flags[k] & TARGET)
+    
+    def is_decoy(self, k):
+        return bool(self._flags[k] & DECOY)
+    
+    def key_at(self, k):
+        return self._keys[k]
+    
+    def index_between(self, _min, _max):
+        return bisect_left(self._keys, _min), bisect_right(self._keys, _max)
+    
+    def find_between(self, _min, _max):
+        i, j = self.index_between(_min, _max)
+        return [self[k] for k in range(i, j)]
+
+
+
+class PeptideList(MappedPeptides):
+    """In-memory counterpart of MappedPeptides, made from (mass, peptide, flags)
+    records sorted on mass."""
+    
+    def __init__(self, records=(), pep_tolerance=1.2):
+        self.fname = None
+        self.pep_tolerance = pep_tolerance
+        self._keys = array('d')
+        self._peptides = []
+        self._flags = bytearray()
+        for mass, pep, flags in records:
+            self._keys.append(mass)
+            self._peptides.append(pep)
+            self._flags.append(flags)
+    
+    def __reduce__(self):
+        return self.__class__, (list(zip(self._keys, self._peptides, self._flags)), self.pep_tolerance)
+    
+    def __getitem__(self, k):
+        return self._peptides[k]
+    
+    def __iter__(self):
+        return iter(self._peptides)
+
+
+
+def _write_run(directory, peptides):
+    """Writes {peptide: flags} as a run sorted on (mass, peptide), returns the file name"""
+    return _write_records(directory, ((mass, pep, peptides[pep])
+                                      for mass, pep in sorted((peptide_mass(pep), pep) for pep in peptides)))
+
+
+def _write_records(directory, records):
+    fd, fname = tempfile.mkstemp(suffix='.run', dir=directory)
+    with open(fd, 'w') as f:
+        for mass, pep, flags in records:
+            # repr round-trips floats exactly
+            f.write('{!r}\t{}\t{}\n'.format(mass, pep, flags))
+    return fname
+
+
+def _read_run(fname):
+    with open(fname) as f:
+        for line in f:
+            mass, pep, flags = line.split('\t')
+            yield float(mass), pep, int(flags)
+
+
+def _merge_runs(fnames):
+    """Merges sorted runs, so that equal peptides (which have equal masses) are adjacent,
+    and yields every peptide once, with the flags of all its occurrences"""
+    last_mass, last_pep, last_flags = None, None, 0
+    for mass, pep, flags in heapq.merge(*map(_read_run, fnames)):
+        if pep == last_pep:
+            last_flags |= flags
+            continue
+        if last_pep is not None:
+            yield last_mass, last_pep, last_flags
+        last_mass, last_pep, last_flags = mass, pep, flags
+    if last_pep is not None:
+        yield last_mass, last_pep, last_flags
+
+
+def _reduce_runs(directory, fnames, fan_in) -> '[fname]':
+    """Merges groups of fan_in runs into larger ones, until there are at most fan_in,
+    so merging never opens more than fan_in files at once"""
+    while len(fnames) > fan_in:
+        merged = []
+        for i in range(0, len(fnames), fan_in):
+            group = fnames[i:i+fan_in]
+            if len(group) == 1:
+                merged.append(group[0])
+                continue
+            merged.append(_write_records(directory, _merge_runs(group)))
+            for fname in group:
+                os.remove(fname)
+        fnames = merged
+    return fnames
+
+
+def digest_fasta(fname, missed_cleavages=1) -> '[(peptide, TARGET or DECOY)]':
+    """Digests every protein forwards (targets) and in reverse (decoys)"""
+    chunker = trypsine(missed_cleavages)
+    for prot in progress_bar(read_fasta(fname), 'Loading proteins'):
+        for pep in chunker(prot.seq):
+            yield pep, TARGET
+        for pep in chunker(prot.seq[::-1]):
+            yield pep, DECOY
+
+
+def build_peptide_store(fasta, fname, missed_cleavages=1, pep_tolerance=1.2, run_size=1 << 21, tmp_dir=None,
+                        fan_in=256):
+    """Builds a store straight from a FASTA file, with bounded memory. Digested peptides
+    (targets and reversed decoys) are collected until there are run_size of them, and then
+    written to a temporary file sorted on mass. Finally, all these runs are merged (removing
+    duplicates) into the store, at most fan_in at a time (in several passes if needed, so
+    the limit on open files isn't hit). Open it with `ProteinDB2.load`."""
+    
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as directory:
+        runs = []
+        peptides = {}
+        for pep, flag in digest_fasta(fasta, missed_cleavages):
+            peptides[pep] = peptides.get(pep, 0) | flag
+            if len(peptides) >= run_size:
+                runs.append(_write_run(directory, peptides))
+                peptides = {}
+        if peptides or not runs:
+            runs.append(_write_run(directory, peptides))
+        del peptides
+        
+        with progress('Merging {} runs into {}'.format(len(runs), fname)):
+            runs = _reduce_runs(directory, runs, fan_in)
+            write_peptide_store(fname, _merge_runs(runs), pep_tolerance)
@@ -7,7 +7,7 @@ Author: Evert Heylen
 
 Commandline usage:
 
-   - for MS1: ``python -m ms.MS1 <MS1 sample>``
+   - for MS1: ``python -m ms.MS1 <MS1 samples or directories>``
     
    - for Tandem MS: ``python -m ms.MS2 <MS2 sample>``
    
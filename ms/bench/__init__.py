@@ -0,0 +1,9 @@
+"""Benchmarks on synthetic data, to catch performance regressions between versions.
+
+Usage: ``python -m ms.bench [-o results.json] [--compare old.json]``, see ``--help``
+for the size of the generated data. Every stage (FASTA parsing, digestion, building,
+saving and loading the database, preprocessing and searching spectra) is timed
+separately.
+"""
+
+from .synthetic import random_proteins, write_fasta, planted_spectra, write_mgf
@@ -0,0 +1,129 @@
+import io
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import contextlib
+
+from ms.util import *
+from ms.MS2 import *
+from ms.MS2.store import build_peptide_store
+from .synthetic import *
+
+parser = argparse.ArgumentParser(description='Benchmarks on synthetic data')
+parser.add_argument('-n', '--proteins', help='Amount of proteins', type=int, default=1000)
+parser.add_argument('-s', '--spectra', help='Amount of spectra', type=int, default=100)
+parser.add_argument('-m', '--missed-cleavages', help='Missed cleavages', type=int, default=1)
+parser.add_argument('-t', '--pep-tolerance', help='Tolerance on the precursor mass', type=float, default=1.2)
+parser.add_argument('--seed', help='Seed for the synthetic data', type=int, default=0)
+parser.add_argument('--scorers', help="Scorers to search with, eval'd", nargs='+',
+                                 default=['SharedPeaks(0.1)', 'Sequest(0.1)', 'BinnedSequest()'])
+parser.add_argument('-l', '--label', help='Label for this run, e.g. a version', default='')
+parser.add_argument('-o', '--output', help='Write the results to this file, as JSON', default=None)
+parser.add_argument('--compare', help='Results (JSON) of an earlier run to compare with', default=None)
+args = parser.parse_args()
+
+stages = {}
+accuracy = {}
+
+
+@contextlib.contextmanager
+def stage(name, items=None):
+    """Times a stage, without the output of the package"""
+    print(progress_start.format(name), end='', flush=True)
+    result = {'items': items}
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        yield result
+        seconds = time.perf_counter() - start
+    result['seconds'] = seconds
+    if result['items']:
+        result['per_item'] = seconds / result['items']
+    stages[name] = result
+    print(progress_end.format(name) + '{:.3f}s'.format(seconds))
+
+
+with tempfile.TemporaryDirectory() as directory:
+    fasta = os.path.join(directory, 'synthetic.fasta')
+    write_fasta(fasta, random_proteins(args.proteins, args.seed))
+    
+    with stage('Parsing FASTA') as s:
+        proteins = list(read_fasta(fasta))
+        s['items'] = len(proteins)
+    
+    with stage('Digestion') as s:
+        chunker = trypsine(args.missed_cleavages)
+        s['items'] = sum(len(list(chunker(p.seq))) + len(list(chunker(p.seq[::-1]))) for p in proteins)
+    
+    with stage('Building ProteinDB2') as s:
+        db = ProteinDB2(fasta, args.missed_cleavages, args.pep_tolerance)
+        s['items'] = len(db.peptides)
+    
+    pickled = os.path.join(directory, 'db.pickle')
+    mapped = os.path.join(directory, 'db.store')
+    with stage('Saving (pickle)'):
+        db.save(pickled)
+    with stage('Loading (pickle)'):
+        ProteinDB2.load(pickled)
+    with stage('Saving (mapped)'):
+        db.save(mapped, mapped=True)
+    with stage('Loading (mapped)'):
+        ProteinDB2.load(mapped)
+    with stage('Building out of core') as s:
+        build_peptide_store(fasta, mapped, args.missed_cleavages, args.pep_tolerance)
+    
+    peptides = [p for p in db.targets if 6 <= len(p) <= 30]
+    planted = list(planted_spectra(peptides, args.spectra, args.seed))
+    mgf = os.path.join(directory, 'synthetic.mgf')
+    write_mgf(mgf, (espec for espec, pep in planted))
+    
+    with stage('Parsing MGF') as s:
+        spectra = ExpMs2Spectrum.load_spectra(mgf)
+        s['items'] = len(spectra)
+    
+    for expr in args.scorers:
+        scorer = eval(expr)
+        with stage('{}.preprocess_espec'.format(expr), len(spectra)):
+            for espec in spectra:
+                scorer.preprocess_espec(espec)
+        
+        with stage('Search ({})'.format(expr), len(spectra)):
+            results = [db.find_best_peptides(espec, scorer, amount=10) for espec in spectra]
+        found = sum(1 for (espec, pep), best in zip(planted, results)
+                    if best and best[0][0] == 'TARGET ' + pep)
+        accuracy[expr] = found / len(spectra)
+
+results = {
+    'label': args.label,
+    'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+    'python': '{} {}'.format(platform.python_implementation(), platform.python_version()),
+    'parameters': vars(args),
+    'stages': stages,
+    'accuracy': accuracy,
+}
+
+if args.output:
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+print('')
+if args.compare:
+    with open(args.compare) as f:
+        old = json.load(f)
+    data = [('stage', 'old (s)', 'new (s)', 'new/old')]
+    for name, result in stages.items():
+        if name in old['stages']:
+            old_seconds = old['stages'][name]['seconds']
+            data.append((name, '{:.4f}'.format(old_seconds), '{:.4f}'.format(result['seconds']),
+                         '{:.2f}'.format(result['seconds'] / old_seconds) if old_seconds else '-'))
+else:
+    data = [('stage', 'seconds', 'items', 'per item (ms)')]
+    data += [(name, '{:.4f}'.format(r['seconds']), r['items'] or '',
+              '{:.4f}'.format(1000*r['per_item']) if 'per_item' in r else '')
+             for name, r in stages.items()]
+print(as_rest_table(data))
+print('')
+print(as_rest_table([('scorer', 'top hit is planted peptide')] + list(accuracy.items())))
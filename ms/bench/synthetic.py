@@ -0,0 +1,77 @@
+"""Reproducible synthetic proteomes (FASTA) and MS2 spectra (MGF)"""
+
+import random
+
+from ms.util import *
+
+
+amino_acids = ''.join(sorted(a for a in amino_weights if a != 'U'))
+
+
+def random_proteins(amount, seed=0, min_length=50, max_length=800) -> '[Sequence]':
+    rng = random.Random(seed)
+    for i in range(amount):
+        seq = ''.join(rng.choice(amino_acids) for _ in range(rng.randint(min_length, max_length)))
+        yield Sequence('sp|S{:06}|SYNTH{}_HUMAN Synthetic protein {}'.format(i, i, i), seq)
+
+
+def write_fasta(fname, proteins, line_length=60):
+    with open(fname, 'w') as f:
+        for prot in proteins:
+            f.write('>' + prot.name + '\n')
+            for i in range(0, len(prot.seq), line_length):
+                f.write(prot.seq[i:i+line_length] + '\n')
+
+
+def planted_spectra(peptides, amount, seed=0, coverage=0.7, noise_peaks=60, jitter=0.05,
+                    pep_jitter=0.3) -> '[(ExpMs2Spectrum, peptide)]':
+    """Spectra of peptides picked from peptides. Every spectrum has a fraction coverage of
+    the b and y ions of its peptide (moved by at most jitter), and noise_peaks random
+    peaks. The title of a spectrum contains its peptide."""
+    from ms.MS2 import ExpMs2Spectrum
+    from ms.MS2.db import Ionizer
+    
+    rng = random.Random(seed)
+    peptides = list(peptides)
+    for i in range(amount):
+        pep = rng.choice(peptides)
+        peaks = [(m + rng.uniform(-jitter, jitter), rng.uniform(10.0, 1000.0))
+                 for m in Ionizer.default(pep) if rng.random() < coverage]
+        peaks += [(rng.uniform(100.0, 2000.0), rng.uniform(1.0, 300.0)) for _ in range(noise_peaks)]
+        pepmass = peptide_mass(pep) + rng.uniform(-pep_jitter, pep_jitter)
+        yield ExpMs2Spectrum('synthetic {} {}'.format(i, pep), pepmass, peaks), pep
+
+
+def write_mgf(fname, spectra):
+    with open(fname, 'w') as f:
+        for espec in spectra:
+            f.write('BEGIN IONS\nTITLE={}\nPEPMASS={!r}\nCHARGE=1+\n'.format(espec.title, espec.pepmass))
+            for loc, intensity in zip(espec.locations, espec.intensities):
+                f.write('{!r} {!r}\n'.format(loc, intensity))
+            f.write('END IONS\n\n')
+
+
+
+# Tests
+
+import unittest
+
+class SyntheticTest(unittest.TestCase):
+    def test_reproducible(self):
+        self.assertEqual([p.seq for p in random_proteins(3, seed=4)],
+                         [p.seq for p in random_proteins(3, seed=4)])
+    
+    def test_mgf(self):
+        import os
+        import tempfile
+        from ms.MS2 import ExpMs2Spectrum
+        spectra = [espec for espec, pep in planted_spectra(['FIELDDEK', 'GARPER'], 4, noise_peaks=5)]
+        with tempfile.NamedTemporaryFile(suffix='.mgf', delete=False) as f:
+            pass
+        try:
+            write_mgf(f.name, spectra)
+            loaded = ExpMs2Spectrum.load_spectra(f.name)
+            self.assertEqual([(e.title, e.pepmass, e.peaks) for e in loaded],
+                             [(e.title, e.pepmass, e.peaks) for e in spectra])
+        finally:
+            os.remove(f.name)
@@ -16,6 +16,13 @@ if "--all" in sys.argv:
 from .util import *
 from .MS1 import *
 from .MS2 import *
+from .MS2.spectra import *
+from .MS2.db import *
+from .MS2.scoring import *
+from .MS2.parallel import *
+from .MS2.output import *
+from .MS2.shards import *
+from .bench.synthetic import *
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,9 @@
 """Various biology-related utilities and data, like FASTA parsing and trypsine."""
 
+import re
+from array import array
+from itertools import accumulate
+
 from .etc import memoize
 
 amino_weights = {
@@ -30,32 +34,43 @@ water = 18.011
 proton = 1.007
 
 class _trypsine:
+    # Cleaves after K or R unless they are followed by P (or at the end)
+    cleavage = re.compile('[KR](?=[^P])')
+    
     def __init__(self, missed_cleavages=0):
         self.missed_cleavages = missed_cleavages
     
+    def spans(self, seq) -> '[(start, end)]':
+        """All peptides as ranges of seq, in the same order as __call__"""
+        bounds = [0]
+        bounds.extend(m.end() for m in self.cleavage.finditer(seq))
+        bounds.append(len(seq))
+        
+        for length in range(1, min(self.missed_cleavages+1, len(bounds)-1) + 1):
+            for i in range(len(bounds)-length):
+                yield bounds[i], bounds[i+length]
+    
+    def digest(self, seq) -> '[(start, end, mass)]':
+        """Like spans, but also gives the mass of every peptide, from the prefix masses
+        of seq. No strings are made, slice seq when needed."""
+        prefix = prefix_masses(seq)
+        extra = water + proton
+        for start, end in self.spans(seq):
+            yield start, end, prefix[end] - prefix[start] + extra
+    
     def __call__(self, seq):
         'Cleaves after K or R unless they are followed by P'
-        buf = ''
-        chunks = []
-        
-        for i in range(len(seq)-1):
-            buf += seq[i]
-            if (seq[i] == 'R' or seq[i] == 'K') and not (seq[i+1] == 'P'):
-                chunks.append(buf)
-                buf = ''
-        
-        buf += seq[-1]
-        chunks.append(buf)
-        yield from chunks
-        
-        for length in range(1, self.missed_cleavages+1):
-            for i in range(len(chunks)-length):
-                yield ''.join(chunks[i:i+length+1])
+        for start, end in self.spans(seq):
+            yield seq[start:end]
 
 @memoize
 def trypsine(missed_cleavages=0):
     return _trypsine(missed_cleavages)
 
+def prefix_masses(seq) -> 'array':
+    """prefix[i] is the mass of the residues seq[:i]"""
+    return array('d', accumulate(map(amino_weights.__getitem__, seq), initial=0.0))
+
 def peptide_mass(seq):
     return sum(amino_weights[c] for c in seq) + water + proton
 
@@ -80,22 +95,58 @@ class Sequence:
     __slots__ = ('name', 'seq', 'weights', 'chunks')
     
 
-def read_fasta(filename):
-    buf = ""
+def read_fasta(filename, offsets=False):
+    """Parses a FASTA file lazily, one sequence at a time. With offsets, no sequences are
+    built: (name, start, end) is yielded instead, with start and end the range of bytes
+    the sequence spans in the file (see `fasta_sequence`).
+    """
+    if offsets:
+        yield from _fasta_offsets(filename)
+        return
+    
+    buf = []
     name = ""
-    with open(filename) as f:
-        for l in f.readlines():
-            if len(l) > 0:
-                if l[0] == ">":
-                    if buf != "":
-                        yield Sequence(name.strip(), buf)
-                        buf = ""
-                    name = l[1:]
-                else:
-                    buf += l[:-1]
-    if buf != "":
-        yield Sequence(name.strip(), buf)
-
+    # Reading lines from a buffered file already reads in (large) chunks
+    with open(filename, buffering=fasta_chunk_size) as f:
+        for l in f:
+            if l[:1] == ">":
+                if buf:
+                    yield Sequence(name.strip(), ''.join(buf))
+                    buf = []
+                name = l[1:]
+            else:
+                # Blank lines add nothing, so empty records are skipped like with offsets
+                l = l.strip()
+                if l:
+                    buf.append(l)
+    if buf:
+        yield Sequence(name.strip(), ''.join(buf))
+
+fasta_chunk_size = 1 << 20
+
+
+def _fasta_offsets(filename):
+    name = ""
+    start = end = pos = 0
+    with open(filename, 'rb', buffering=fasta_chunk_size) as f:
+        for l in f:
+            pos += len(l)
+            if l[:1] == b">":
+                if end > start:
+                    yield (name, start, end)
+                name = l[1:].decode().strip()
+                start = end = pos
+            elif not l.isspace():
+                end = pos
+    if end > start:
+        yield (name, start, end)
+
+
+def fasta_sequence(f, start, end):
+    """Reads a sequence from a FASTA file (opened in binary mode), given the
+    offsets from `read_fasta(..., offsets=True)`"""
+    f.seek(start)
+    return b''.join(f.read(end - start).split()).decode()
 
 # Tests
 
@@ -117,3 +168,41 @@ class Trypsine(unittest.TestCase):
                                   'GARFIELDDEK', 'FIELDDEKARPER',
                                   'GARFIELDDEKARPER'])
 
+    
+    def test_digest(self):
+        for missed_cleavages in range(4):
+            for seq in ('GARFIELDDEKARPER', 'KKRPK', 'G'):
+                chunks = list(trypsine(missed_cleavages)(seq))
+                digested = list(trypsine(missed_cleavages).digest(seq))
+                self.assertEqual([seq[s:e] for s, e, m in digested], chunks)
+                for chunk, (s, e, mass) in zip(chunks, digested):
+                    self.assertAlmostEqual(mass, peptide_mass(chunk))
+
+class ReadFasta(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        with tempfile.NamedTemporaryFile('w', suffix='.fasta', delete=False) as f:
+            # No trailing newline
+            f.write('>first protein\nGARFIELD\nDEK\n\n>second\nARPER\r\nMEGA')
+            self.fasta = f.name
+    
+    def tearDown(self):
+        import os
+        os.remove(self.fasta)
+    
+    def test_sequences(self):
+        seqs = [(s.name, s.seq) for s in read_fasta(self.fasta)]
+        self.assertEqual(seqs, [('first protein', 'GARFIELDDEK'), ('second', 'ARPERMEGA')])
+    
+    def test_offsets(self):
+        offsets = list(read_fasta(self.fasta, offsets=True))
+        self.assertEqual([o[0] for o in offsets], ['first protein', 'second'])
+        with open(self.fasta, 'rb') as f:
+            self.assertEqual([fasta_sequence(f, start, end) for _, start, end in offsets],
+                             ['GARFIELDDEK', 'ARPERMEGA'])
+    
+    def test_empty_records(self):
+        with open(self.fasta, 'w') as f:
+            f.write('\n>empty\n>first\nGAR\n\n>blank\n  \n\n>second\nDEK\n')
+        self.assertEqual([(s.name, s.seq) for s in read_fasta(self.fasta)], [('first', 'GAR'), ('second', 'DEK')])
+        self.assertEqual([o[0] for o in read_fasta(self.fasta, offsets=True)], ['first', 'second'])
@@ -1,7 +1,12 @@
 """Various utilities, with no direct biological use"""
 
 import os
+import sys
+import time
+import heapq
 from functools import wraps
+from contextlib import contextmanager
+from collections import defaultdict
 
 try:
     import cPickle as pickle
@@ -20,7 +25,7 @@ def data_loc(location):
 
 
 def nice_lines(f):
-    for l in f.readlines():
+    for l in f:
         if not l.isspace():
             yield l.strip()
 
@@ -51,22 +56,56 @@ def print_scores(scores: '[(name, score)]', title=str, normalize=True):
 def progress_bar(l, text, length=None, size=40):
     """Shows a progress bar while iterating over a list.
     Avoids printing all the time and making your program IO-bound.
+    If the length isn't known (e.g. for generators), the items are counted instead.
+    The iteration is recorded as a stage in `stats`.
     """
     
+    if stats.quiet or (length is None and not hasattr(l, '__len__')):
+        yield from progress_counter(l, text)
+        return
+    
     modulo = max(round((length or len(l))/size), 1)
-    progress = 0
-    for i, item in enumerate(l):
-        if i%modulo == 0:
-            print(progress_bar_start.format(text) + '#'*progress + ' '*(size-progress) + ']', end='', flush=True)
-            progress += 1
-        yield item
+    done = 0
+    i = -1
+    with stats.stage(text) as stage:
+        for i, item in enumerate(l):
+            if i%modulo == 0:
+                print(progress_bar_start.format(text) + '#'*done + ' '*(size-done) + ']', end='', flush=True)
+                done += 1
+            yield item
+        stage.items = i + 1
     print(progress_end.format(text) + ' '*size)
 
+
+def progress_counter(l, text, every=100):
+    """Like `progress_bar`, for iterables of unknown length"""
+    
+    i = 0
+    with stats.stage(text) as stage:
+        for i, item in enumerate(l, 1):
+            if i%every == 0 and not stats.quiet:
+                print(progress_start.format(text) + str(i), end='', flush=True)
+            yield item
+        stage.items = i
+    if not stats.quiet:
+        print(progress_end.format(text) + '({} items)'.format(i))
+
 progress_bar_start = '\r{: <40}  ['
 progress_start = '\r{: <40}  ... '
 progress_end = '\r{: <40}  Done. '
 
 
+@contextmanager
+def progress(text):
+    """Shows text while the body runs, and records it as a stage in `stats`"""
+    if not stats.quiet:
+        print(progress_start.format(text), end='', flush=True)
+    with stats.stage(text) as stage:
+        yield stage
+    if not stats.quiet:
+        print(progress_end.format(text))
+
+
 def simple_progress(text):
     """Similar to `progress_bar`, but for when you want to wait on the result of a function
     instead of monitoring a for loop. Therefore, this is a decorator.
@@ -75,46 +114,311 @@ def simple_progress(text):
     def decorator(func):
         @wraps(func)
         def new_func(*a, **kw):
-            print(progress_start.format(text), end='')
-            res = func(*a, **kw)
-            print(progress_end.format(text))
-            return res
+            with progress(text):
+                return func(*a, **kw)
         return new_func
     return decorator
 
 
 
+# Instrumentation
+# ===============
+
+try:
+    import resource
+except ImportError:  # Not on Windows
+    resource = None
+
+
+def process_peak_memory():
+    """Peak memory use of this whole process so far (its high-water mark), in MiB
+    (None if unknown)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kiB, macOS bytes
+    return peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10)
+
+
+class Stage:
+    """Totals of a named stage, over all the times it ran"""
+    
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.items = 0
+        # Not the peak of the stage itself: later stages report at least the same
+        self.process_peak_memory = None
+    
+    def as_dict(self):
+        return {'calls': self.calls, 'seconds': self.seconds, 'items': self.items,
+                'process_peak_memory': self.process_peak_memory}
+
+
+class _RunningStage:
+    # What `Stats.stage` yields: set items to the amount of work done
+    __slots__ = ('items',)
+    
+    def __init__(self):
+        self.items = 0
+
+
+class Stats:
+    """Records wall time and item counts of named stages (like 'Loading proteins',
+    everything shown by `progress_bar` and friends is one), and rows of per-item
+    records (like the candidates of every spectrum). After every stage, the peak
+    memory of the process so far is noted: a high-water mark, not the memory the
+    stage itself used.
+    Disabled, recording costs next to nothing. The module level `stats` is the
+    one used by the package; enable it with `stats.enabled = True`.
+    
+    Only the process that records has the data, so work done by other processes
+    (see `pool_map`) only counts as a whole.
+    """
+    
+    def __init__(self, enabled=False, quiet=False):
+        self.enabled = enabled
+        self.quiet = quiet  # Hides all progress output, enabled or not
+        self.clear()
+    
+    def clear(self):
+        self.stages = {}
+        self.records = defaultdict(list)
+    
+    @contextmanager
+    def stage(self, name):
+        """Times the body as (another run of) the stage name"""
+        running = _RunningStage()
+        if not self.enabled:
+            yield running
+            return
+        
+        start = time.perf_counter()
+        try:
+            yield running
+        finally:
+            seconds = time.perf_counter() - start
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = Stage(name)
+            stage.calls += 1
+            stage.seconds += seconds
+            stage.items += running.items
+            stage.process_peak_memory = process_peak_memory()
+    
+    def record(self, table, **row):
+        """Adds a row (e.g. title=..., candidates=...) to a table of records"""
+        if self.enabled:
+            self.records[table].append(row)
+    
+    @contextmanager
+    def timed(self, table, **row):
+        """Like `record`, adding the seconds the body took to the row.
+        The body can add more to the row it gets."""
+        if not self.enabled:
+            yield row
+            return
+        
+        start = time.perf_counter()
+        try:
+            yield row
+        finally:
+            row['seconds'] = time.perf_counter() - start
+            self.records[table].append(row)
+    
+    def as_dict(self):
+        return {'stages': {name: stage.as_dict() for name, stage in self.stages.items()},
+                'records': dict(self.records)}
+    
+    def save(self, fname):
+        """Writes everything to a JSON file"""
+        import json
+        with open(fname, 'w') as f:
+            json.dump(self.as_dict(), f, indent=1)
+    
+    def summary(self, slowest=5):
+        """A table of all stages, and the slowest records of each table"""
+        data = [('stage', 'calls', 'seconds', 'items', 'process peak MiB')]
+        data += [(s.name, s.calls, '{:.3f}'.format(s.seconds), s.items or '',
+                  '' if s.process_peak_memory is None else '{:.1f}'.format(s.process_peak_memory))
+                 for s in self.stages.values()]
+        text = as_rest_table(data)
+        
+        for table, rows in self.records.items():
+            if not rows:
+                continue
+            keys = list(rows[0])
+            if 'seconds' in keys:
+                rows = heapq.nlargest(slowest, rows, key=lambda r: r['seconds'])
+                title = 'Slowest {} of {} {}'.format(len(rows), len(self.records[table]), table.lower())
+            else:
+                rows = rows[:slowest]
+                title = 'First {} of {} {}'.format(len(rows), len(self.records[table]), table.lower())
+            data = [keys] + [['{:.4f}'.format(v) if isinstance(v, float) else v
+                              for v in (row.get(k, '') for k in keys)] for row in rows]
+            text += '\n\n' + title + '\n' + '-'*len(title) + '\n\n' + as_rest_table(data)
+        return text
+
+stats = Stats()
+
+
+
 # Pickling help
 # =============
 
 class Pickled:
     def save(self, fname = None):
         fname = fname or self._loaded_from
-        text = 'Saving {} to {}'.format(type(self).__name__, fname)
-        print(progress_start.format(text), end='')
         import gc
-        with open(fname, 'wb') as f:
+        with progress('Saving {} to {}'.format(type(self).__name__, fname)), open(fname, 'wb') as f:
             gc.disable()
             pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
             gc.enable()
-        print(progress_end.format(text))
     
     @classmethod
     def load(cls, fname):
-        text = 'Loading {} from {}'.format(cls.__name__, fname)
-        print(progress_start.format(text), end='')
         import gc
-        with open(fname, 'rb') as f:
+        with progress('Loading {} from {}'.format(cls.__name__, fname)), open(fname, 'rb') as f:
             gc.disable()
             data = pickle.load(f)
             gc.enable()
         data.__class__ = cls
         data._loaded_from = fname
-        print(progress_end.format(text))
         return data
 
 
 
+# Multiprocessing help
+# ====================
+
+# Forked workers inherit this from the parent (copy-on-write), so large shared
+# data (like a database) doesn't have to be pickled to every worker.
+_pool_shared = None
+
+
+def _init_pool_worker(shared=None):
+    global _pool_shared
+    if shared is not None:
+        _pool_shared = shared
+
+
+def _call_pool_func(func, item):
+    return func(_pool_shared, item)
+
+
+def pool_map(func, items, workers=1, shared=None, backlog=None) -> '[(item, result)]':
+    """Yields (item, func(shared, item)) for every item, in order. With workers > 1,
+    func is called in a pool of processes (so it has to be picklable, e.g. a module
+    level function). Where possible, workers are forked, so they share `shared`
+    with this process instead of getting a pickled copy. At most backlog items are
+    sent ahead, so items can be a (large) stream.
+    
+    The pool is started right away, in the calling thread, not when the results are
+    iterated. Call this before starting threads (e.g. `prefetch`), forking a process
+    with other threads running can deadlock it.
+    """
+    
+    if workers <= 1:
+        return ((item, func(shared, item)) for item in items)
+    
+    import gc
+    import multiprocessing
+    
+    global _pool_shared
+    _pool_shared = shared
+    if 'fork' in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context('fork')
+        initargs = ()
+        # Keep the garbage collector from touching (and thus copying) the shared pages
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+    else:
+        # Without fork, every worker gets its own (pickled) copy
+        ctx = multiprocessing.get_context()
+        initargs = (shared,)
+    
+    try:
+        pool = ctx.Pool(workers, _init_pool_worker, initargs)
+    except BaseException:
+        _end_pool_map()
+        raise
+    return _pool_results(pool, func, items, backlog or 4*workers)
+
+
+def _pool_results(pool, func, items, backlog):
+    from collections import deque
+    
+    pending = deque()
+    try:
+        with pool:
+            for item in items:
+                pending.append((item, pool.apply_async(_call_pool_func, (func, item))))
+                if len(pending) >= backlog:
+                    item, result = pending.popleft()
+                    yield item, result.get()
+            while pending:
+                item, result = pending.popleft()
+                yield item, result.get()
+    finally:
+        _end_pool_map()
+
+
+def _end_pool_map():
+    # Workers that replace dead ones need the shared data, so this waits until the end
+    global _pool_shared
+    import gc
+    _pool_shared = None
+    if hasattr(gc, 'unfreeze'):
+        gc.unfreeze()
+
+
+
+def prefetch(items, size=64):
+    """Iterates over items in a background thread, at most size items ahead, so that
+    producing them (parsing a file, or searching in a pool) overlaps with consuming
+    them. Stacking these makes a pipeline with bounded queues in between. Exceptions
+    are raised in the consumer. Mind that only one thread at a time runs Python code.
+    The thread is started when the first item is asked for.
+    """
+    
+    import queue
+    import threading
+    
+    done = object()
+    stop = threading.Event()
+    q = queue.Queue(size)
+    
+    def produce():
+        try:
+            for item in items:
+                q.put((item, None))
+                if stop.is_set():
+                    return
+            q.put((done, None))
+        except BaseException as e:
+            q.put((done, e))
+    
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = q.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        # If the consumer stops early, unblock the producer so it can notice
+        stop.set()
+        while thread.is_alive():
+            try:
+                q.get(timeout=0.01)
+            except queue.Empty:
+                pass
+
+
 # Various more utilities
 # ======================
 
@@ -134,14 +438,17 @@ def frange(start, end=None, stepsize=1.0):
         i += stepsize
 
 
-def dot_product(x_loc: list, x_val: float, y: list, tolerance=1.0):
+def dot_product(x_loc: list, x_val: float, y_loc: list, y_val: list, tolerance=1.0):
+    """Works on any sequences (like arrays), y_loc and y_val are the locations and
+    values of y."""
     i, j = 0, 0
+    len_x, len_y = len(x_loc), len(y_loc)
     total = 0.0
-    while i != len(x_loc) and j != len(y):
-        if abs(x_loc[i] - y[j][0]) <= tolerance:
-            total += x_val * y[j][1]
+    while i != len_x and j != len_y:
+        if abs(x_loc[i] - y_loc[j]) <= tolerance:
+            total += x_val * y_val[j]
         
-        if (x_loc[i] < y[j][0] and not i == len(x_loc)-1) or j == len(y)-1:
+        if (x_loc[i] < y_loc[j] and not i == len_x-1) or j == len_y-1:
             i += 1
         else:
             j += 1
@@ -312,6 +619,14 @@ class SortedCollection:
         i = bisect_left(self._keys, _min)
         j = bisect_right(self._keys, _max)
         return [self._items[k] for k in range(i, j)]
+    
+    def index_between(self, _min, _max):
+        """Own addition: like find_between, but returns the range (i, j) of indices"""
+        return bisect_left(self._keys, _min), bisect_right(self._keys, _max)
+    
+    def key_at(self, i):
+        """Own addition: the key of the item at index i"""
+        return self._keys[i]
 
 
 import unittest
@@ -332,3 +647,61 @@ class SortedCollectionBetweenTests(unittest.TestCase):
     def test_end(self):
         self.assertEqual(self.sc.find_between(456, 456.1), [456])
         self.assertEqual(self.sc.find_between(456.1, 456.2), [])
+    
+    def test_index(self):
+        self.assertEqual(self.sc.index_between(1, 43), (1, 5))
+        self.assertEqual(self.sc.index_between(456.1, 456.2), (6, 6))
+
+
+class StatsTest(unittest.TestCase):
+    def setUp(self):
+        self.old_enabled, self.old_quiet = stats.enabled, stats.quiet
+        stats.enabled, stats.quiet = True, True
+        stats.clear()
+    
+    def tearDown(self):
+        stats.enabled, stats.quiet = self.old_enabled, self.old_quiet
+        stats.clear()
+    
+    def test_stages(self):
+        self.assertEqual(list(progress_bar(range(5), 'Counting')), list(range(5)))
+        list(progress_bar(iter(range(3)), 'Counting'))
+        simple_progress('Waiting')(lambda: None)()
+        self.assertEqual((stats.stages['Counting'].calls, stats.stages['Counting'].items), (2, 8))
+        self.assertEqual(stats.stages['Waiting'].calls, 1)
+        self.assertIn('Waiting', stats.summary())
+    
+    def test_records(self):
+        with stats.timed('Spectra', title='a') as row:
+            row['candidates'] = 3
+        stats.record('Spectra', title='b', candidates=1, seconds=0.0)
+        self.assertEqual([(r['title'], r['candidates']) for r in stats.records['Spectra']],
+                         [('a', 3), ('b', 1)])
+        self.assertIn('Slowest 2 of 2 spectra', stats.summary())
+    
+    def test_disabled(self):
+        stats.enabled = False
+        list(progress_bar(range(5), 'Counting'))
+        stats.record('Spectra', title='a')
+        self.assertEqual(stats.as_dict(), {'stages': {}, 'records': {}})
+
+
+class PrefetchTest(unittest.TestCase):
+    def test_order(self):
+        self.assertEqual(list(prefetch(range(100), size=3)), list(range(100)))
+    
+    def test_error(self):
+        def failing():
+            yield 1
+            raise KeyError('failed')
+        items = prefetch(failing())
+        self.assertEqual(next(items), 1)
+        self.assertRaises(KeyError, next, items)
+    
+    def test_stop(self):
+        import itertools
+        produced = []
+        items = prefetch((produced.append(i) or i for i in itertools.count()), size=2)
+        self.assertEqual([next(items) for i in range(5)], list(range(5)))
+        items.close()
+        self.assertLess(len(produced), 10)